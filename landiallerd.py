@@ -35,15 +35,19 @@ the documentation for the server.
 The client and server communicate via XML-RPC. The server runs in the
 background (as a daemon) waiting for clients to connect to it and
 request an Internet connection (through the LANdialler XML-RPC API).
-By default the server listen for connections on port 6543.
+By default the server listen for connections on port 6543. Small
+clients can use a compact UDP protocol instead (see DatagramHandler)
+by setting udp_port in the [general] section.
 
 The client/server API defines three procedures that the client can
 call; connect(), disconnect() and get_status(). These are individually
-documented below. Each procedure runs an external script/program to
-perform their task, making the server more portable between different
-versions of Unix, or distributions of Linux. Each command should
-return immediately. Commands are specified in the [commands] section
-of the landiallerd.conf configuration file.
+documented below. get_status_many() and the standard system.multicall()
+let a single request carry the calls for several clients. Each
+procedure runs an external script/program to perform their task,
+making the server more portable between different versions of Unix,
+or distributions of Linux. Each command should return immediately.
+Commands are specified in the [commands] section of the
+landiallerd.conf configuration file.
 
 A sample configuration file should be included with the package, but
 the following should serve as a good example:
@@ -59,6 +63,12 @@ the following should serve as a good example:
 Note that you can also configure the TCP port number that landiallerd.py
 uses to communicate with the clients.
 
+Rather than running the is_connected command, the server can check
+the state of the network interface itself. Set link_probe in the
+[general] section to "sysfs", "procfs" or "ioctl" (and interface to
+the name of the PPP interface, ppp0 by default) to avoid starting a
+new process every time the link is checked.
+
 The connect and disconnect scripts referenced in the config file
 should both make sure that they exit immediately; the connect command
 MUST NOT block before the connection has been made. If you have
@@ -75,11 +85,24 @@ The author can be contacted at ashtong@users.sourceforge.net.
 """
 
 
+import asynchat
+import asyncore
+import BaseHTTPServer
+import collections
 import ConfigParser
+import fcntl
 import getopt
+import heapq
 import os
+import Queue
+import random
+import re
+import signal
 import SimpleXMLRPCServer
+import socket
 import SocketServer
+import struct
+import subprocess
 import sys
 import syslog
 import threading
@@ -87,26 +110,388 @@ import time
 import xmlrpclib
 
 
-class Logger:
+class LazyModule(object):
+
+    """Imports a module the first time one of its attributes is used.
+
+    Only some configurations need urllib and sqlite3, and importing
+    them takes a noticeable time on a slow router, so the daemon only
+    pays for them once they're wanted.
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = __import__(self._name)
+        return getattr(self._module, attr)
+
+
+urllib = LazyModule('urllib')
+sqlite3 = LazyModule('sqlite3')
+
+
+class SyslogBackend:
+
+    """Writes log messages to syslog."""
 
     def __init__(self):
         ident = os.path.splitext(os.path.basename(sys.argv[0]))[0]
         syslog.openlog(ident, syslog.LOG_PID | syslog.LOG_CONS,
                        syslog.LOG_DAEMON)
 
+    def write(self, messages):
+        for priority, msg in messages:
+            syslog.syslog(priority, msg)
+
+
+class StreamBackend:
+
+    """Writes log messages to a file (e.g. stderr in the foreground)."""
+
+    LEVELS = {syslog.LOG_INFO: 'info',
+              syslog.LOG_WARNING: 'warning',
+              syslog.LOG_ERR: 'error'}
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, messages):
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        for priority, msg in messages:
+            self._stream.write('%s %s: %s\n' %
+                               (now, self.LEVELS.get(priority, priority), msg))
+        self._stream.flush()
+
+
+class Logger:
+
+    """Logs messages from a background thread.
+
+    Messages are put on a bounded queue and written out by a writer
+    thread, so logging never blocks the thread handling a request.
+    The writer takes everything waiting on the queue in one go and
+    collapses runs of identical messages into a single "repeated"
+    line. If the queue fills up messages are dropped, and a warning
+    saying how many were lost is logged once there is room again.
+
+    When rate_limit is set, no more than rate_limit copies of the same
+    message are logged per RATE_PERIOD; this stops a client that keeps
+    connecting and disconnecting from flooding the log.
+
+    """
+
+    QUEUE_SIZE = 1000
+    RATE_PERIOD = 60  # seconds
+    MAX_RATE_KEYS = 1000
+
+    # Captured here so that tests can replace the os module.
+    _getpid = staticmethod(os.getpid)
+
+    def __init__(self, backend=None, queue_size=QUEUE_SIZE, rate_limit=0):
+        self._backend = backend
+        self._queue_size = queue_size
+        self.rate_limit = rate_limit
+        self._queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._writer_pid = None
+        self._rates = {}  # msg -> [period start, count]
+        self.dropped = 0
+        self._reported_drops = 0
+        self.suppressed = 0
+
+    def set_backend(self, backend):
+        self.flush()
+        self._backend = backend
+
+    def _start_writer(self):
+        self._lock.acquire()
+        try:
+            if self._writer_pid == self._getpid():
+                return
+            if self._writer_pid is not None:
+                # We've forked; the writer thread didn't come with us.
+                self._queue = Queue.Queue(self._queue_size)
+            self._writer_pid = self._getpid()
+            writer = threading.Thread(target=self._write_messages,
+                                      args=(self._queue,), name='Logger')
+            writer.setDaemon(True)
+            writer.start()
+        finally:
+            self._lock.release()
+
+    def _is_rate_limited(self, msg):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            rate = self._rates.get(msg)
+            if rate is None or now - rate[0] > self.RATE_PERIOD:
+                if len(self._rates) >= self.MAX_RATE_KEYS:
+                    self._rates.clear()
+                rate = [now, 0]
+                self._rates[msg] = rate
+            rate[1] += 1
+            if rate[1] > self.rate_limit:
+                self.suppressed += 1
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def log(self, priority, msg):
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')  # e.g. a non-ASCII client id
+        if self.rate_limit and self._is_rate_limited(msg):
+            return
+        if self._writer_pid != self._getpid():
+            self._start_writer()
+        try:
+            self._queue.put_nowait((priority, msg))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write_messages(self, queue):
+        while True:
+            messages = [queue.get()]
+            try:
+                while True:
+                    messages.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                try:
+                    self._write(messages)
+                except Exception:
+                    # There's nowhere to report it, but the writer must
+                    # keep going or flush() would never return.
+                    pass
+            finally:
+                for i in range(len(messages)):
+                    queue.task_done()
+
+    def _write(self, messages):
+        lines = []
+        if self.dropped != self._reported_drops:
+            lines.append((syslog.LOG_WARNING, 'Log queue full, dropped %d '
+                          'messages' % (self.dropped - self._reported_drops)))
+            self._reported_drops = self.dropped
+        previous = None
+        repeats = 0
+        for message in messages:
+            if message == previous:
+                repeats += 1
+                continue
+            if repeats:
+                lines.append((previous[0], 'last message repeated %d times' %
+                              repeats))
+            lines.append(message)
+            previous = message
+            repeats = 0
+        if repeats:
+            lines.append((previous[0], 'last message repeated %d times' %
+                          repeats))
+        if self._backend is None:
+            self._backend = SyslogBackend()
+        self._backend.write(lines)
+
+    def flush(self):
+        """Wait until every message logged so far has been written."""
+        if self._writer_pid == self._getpid():
+            self._queue.join()
+
     def info(self, msg):
-        syslog.syslog(syslog.LOG_INFO, msg)
+        self.log(syslog.LOG_INFO, msg)
 
     def warn(self, msg):
-        syslog.syslog(syslog.LOG_WARNING, msg)
+        self.log(syslog.LOG_WARNING, msg)
         
     def error(self, msg):
-        syslog.syslog(syslog.LOG_ERR, msg)
+        self.log(syslog.LOG_ERR, msg)
 
 
 log = Logger()
 
 
+def monotonic():
+    """Return seconds since some fixed point, ignoring clock changes."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic()
+    return os.times()[4]
+
+
+request_context = threading.local()
+
+
+def get_client_address():
+    """Return the IP address of the client making the current request."""
+    return getattr(request_context, 'address', None)
+
+
+def get_option(config, section, option, default, convert=str):
+    """Return a config option, or default if it isn't set."""
+    if config.has_option(section, option):
+        return convert(config.get(section, option))
+    return default
+
+
+class Metrics(object):
+
+    """Collects counters, gauges and latency histograms.
+
+    render() returns the metrics in the Prometheus text format. Labels
+    are passed as a tuple of (name, value) pairs.
+
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = []  # (name, type, help)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [counts, sum, count]
+        self._gauges = {}  # name -> function
+
+    def describe(self, name, type, help):
+        self._descriptions.append((name, type, help))
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self.BUCKETS), 0.0, 0]
+                self._histograms[key] = histogram
+            counts = histogram[0]
+            for i in range(len(self.BUCKETS)):
+                if value <= self.BUCKETS[i]:
+                    counts[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+        finally:
+            self._lock.release()
+
+    def set_gauge(self, name, function):
+        """Report the value returned by function as a gauge."""
+        self._gauges[name] = function
+
+    def get(self, name, labels=()):
+        """Return a counter's value, or a histogram's count."""
+        key = (name, labels)
+        if key in self._histograms:
+            return self._histograms[key][2]
+        return self._counters.get(key, 0)
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ''
+        pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                        .replace('"', '\\"'))
+                 for k, v in labels]
+        return '{%s}' % ','.join(pairs)
+
+    def render(self):
+        self._lock.acquire()
+        try:
+            counters = self._counters.items()
+            histograms = [(key, (value[0][:], value[1], value[2]))
+                          for key, value in self._histograms.items()]
+        finally:
+            self._lock.release()
+        counters.sort()
+        histograms.sort()
+        lines = []
+        for name, type, help in self._descriptions:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            if type == 'gauge' and name in self._gauges:
+                lines.append('%s %s' % (name, self._gauges[name]()))
+            for (counter, labels), value in counters:
+                if counter == name:
+                    lines.append('%s%s %s' %
+                                 (name, self._format_labels(labels), value))
+            for (histogram, labels), (counts, total, count) in histograms:
+                if histogram != name:
+                    continue
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (
+                        name, self._format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, self._format_labels(labels + (('le', '+Inf'),)),
+                    count))
+                lines.append('%s_sum%s %f' %
+                             (name, self._format_labels(labels), total))
+                lines.append('%s_count%s %d' %
+                             (name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('landialler_api_calls_total', 'counter',
+                 'Calls to each API method.')
+metrics.describe('landialler_api_rejected_total', 'counter',
+                 'API calls turned away by the rate limits.')
+metrics.describe('landialler_api_call_seconds', 'histogram',
+                 'Time taken to handle API calls.')
+metrics.describe('landialler_link_probe_seconds', 'histogram',
+                 'Time taken to check whether the link is up.')
+metrics.describe('landialler_processes_started_total', 'counter',
+                 'Processes started to run commands (fork/exec).')
+metrics.describe('landialler_expiry_sweep_seconds', 'histogram',
+                 'Time taken to forget clients that have timed out.')
+metrics.describe('landialler_dial_attempts_total', 'counter',
+                 'Times the modem has been dialled.')
+metrics.describe('landialler_dial_failures_total', 'counter',
+                 'Dial attempts that timed out.')
+metrics.describe('landialler_dial_successes_total', 'counter',
+                 'Times dialling has brought the link up.')
+metrics.describe('landialler_clients', 'gauge',
+                 'Clients currently sharing the connection.')
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+
+    """Serves the metrics at /metrics."""
+
+    allow_reuse_address = True
+
+    def __init__(self, addr):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, MetricsHandler)
+
+
 class Timer(object):
 
     """Simple timer class to record elapsed times."""
@@ -137,6 +522,25 @@ class Timer(object):
         self._start_time = time.time()
         self._stop_time = time.time()
 
+    def restore(self, start_time, is_running, stop_time=None):
+        """Restore a timer saved with start_time, is_running and
+        stop_time."""
+        self._start_time = start_time
+        if stop_time is None:
+            stop_time = time.time()
+        self._stop_time = stop_time
+        self.is_running = is_running
+
+    def _get_start_time(self):
+        return self._start_time
+
+    start_time = property(_get_start_time)
+
+    def _get_stop_time(self):
+        return self._stop_time
+
+    stop_time = property(_get_stop_time)
+
     def _get_elapsed_seconds(self):
         """Return seconds since timer started."""
         if self.is_running:
@@ -147,237 +551,3107 @@ class Timer(object):
     elapsed_seconds = property(_get_elapsed_seconds)
 
 
-class Modem(object):
+class LinkStateCache(object):
 
-    def __init__(self, config_parser):
-        self._config_parser = config_parser
-        self.timer = Timer()
+    """Remembers the result of a link probe for a short while.
 
-    def connect(self):
-        log.info('Connecting')
-        self.timer.reset()
-        os.system(self._config_parser.get('commands', 'connect'))
+    Concurrent callers share a single probe; if one thread is already
+    running the probe the others wait for its result rather than
+    starting probes of their own.
 
-    def disconnect(self):
-        log.info('Disconnecting, online for %s seconds' %
-                 self.timer.elapsed_seconds)
-        self.timer.stop()
-        os.system(self._config_parser.get('commands', 'disconnect'))
+    """
 
-    def is_connected(self):
-        rval = os.system(self._config_parser.get('commands', 'is_connected'))
-        if rval == 0:
-            if not self.timer.is_running:
-                self.timer.start()
-            return True
-        else:
-            return False
+    def __init__(self, probe, ttl=0):
+        self._probe = probe
+        self.ttl = ttl
+        self._cond = threading.Condition()
+        self._value = None
+        self._expires = 0
+        self._in_flight = False
+        self._generation = 0
+
+    def _is_fresh(self):
+        return self._value is not None and time.time() < self._expires
+
+    def get(self):
+        """Return the cached link state, probing if it has expired."""
+        self._cond.acquire()
+        try:
+            while True:
+                if self._is_fresh():
+                    return self._value
+                if not self._in_flight:
+                    break
+                generation = self._generation
+                while self._in_flight and self._generation == generation:
+                    self._cond.wait()
+                if self._generation != generation and self._value is not None:
+                    return self._value
+            self._in_flight = True
+        finally:
+            self._cond.release()
+        value = None
+        try:
+            value = self._probe()
+        finally:
+            self._cond.acquire()
+            try:
+                self._in_flight = False
+                self._generation += 1
+                self._value = value
+                self._expires = time.time() + self.ttl
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+        return value
+
+    def invalidate(self):
+        """Forget the cached state so that the next get() probes."""
+        self._cond.acquire()
+        try:
+            self._value = None
+        finally:
+            self._cond.release()
 
 
-class ModemProxy(object):
+class CommandProbe(object):
 
-    CLIENT_TIMEOUT = 30
+    """Checks the link by running the [commands] is_connected command."""
 
-    def __init__(self, modem):
-        self._modem = modem
-        self._clients = {}
-        self._is_dialling = False
+    def __init__(self, config_parser, section=None):
+        self._command = Command('is_connected',
+                                config_parser.get(section or 'commands',
+                                                  'is_connected'))
 
-    def add_client(self, client_id):
-        if client_id not in self._clients:
-            self._clients[client_id] = time.time()
-        if not (self._is_dialling or self.is_connected()):
-            self._is_dialling = True
-            self._modem.connect()
+    def __call__(self):
+        return self._command.run() == 0
 
-    def refresh_client(self, client_id):
-        self._clients[client_id] = time.time()
 
-    def remove_client(self, client_id):
-        if client_id in self._clients:
-            del self._clients[client_id]
-        if not self._clients:
-            if self.is_connected() or self._is_dialling:
-                self.disconnect()
+class SysfsProbe(object):
 
-    def remove_old_clients(self):
-        for client_id, time_last_seen in self._clients.items():
-            if (time.time() - time_last_seen) > self.CLIENT_TIMEOUT:
-                self.remove_client(client_id)
+    """Checks the link by reading the interface's operstate from sysfs.
 
-    def count_clients(self):
-        return len(self._clients.keys())
+    Point-to-point interfaces usually report their state as "unknown"
+    rather than "up", so anything other than "down" counts as up.
 
-    def is_connected(self):
-        if self._modem.is_connected():
-            self._is_dialling = False
-            return True
-        else:
+    """
+
+    PATH = '/sys/class/net/%s/operstate'
+
+    def __init__(self, config_parser, section=None):
+        self._path = self.PATH % get_interface(config_parser, section)
+
+    def __call__(self):
+        try:
+            f = open(self._path)
+            try:
+                return f.read().strip() not in ('', 'down', 'notpresent')
+            finally:
+                f.close()
+        except IOError:
             return False
 
-    def get_time_connected(self):
-        return self._modem.timer.elapsed_seconds
 
-    def disconnect(self):
-        self._is_dialling = False
-        self._modem.disconnect()
+class ProcNetDevProbe(object):
 
+    """Checks the link by looking for the interface in /proc/net/dev.
 
-class API(object):
-    
-    """Implements the LANdialler API.
+    pppd creates the interface before authentication and IPCP have
+    finished (and keeps it for good with the persist and demand
+    options), so the interface must also have been given an address
+    before the link counts as up.
 
-    All accessible methods in this class form a part of the LANdialler
-    XML-RPC API, and are called directly whenever a client makes an
-    HTTP request to the server.
+    """
+
+    PATH = '/proc/net/dev'
+
+    def __init__(self, config_parser, section=None):
+        self._interface = get_interface(config_parser, section)
+        self._has_address = IoctlProbe(config_parser, section)
+
+    def __call__(self):
+        try:
+            f = open(self.PATH)
+            try:
+                for line in f.readlines()[2:]:
+                    if line.split(':', 1)[0].strip() == self._interface:
+                        return self._has_address()
+            finally:
+                f.close()
+        except IOError:
+            pass
+        return False
+
+
+def read_interface_counters(interface, path=ProcNetDevProbe.PATH):
+    """Return (rx_bytes, tx_bytes) for interface, or None if it's down."""
+    try:
+        f = open(path)
+        try:
+            lines = f.readlines()[2:]
+        finally:
+            f.close()
+    except IOError:
+        return None
+    for line in lines:
+        fields = line.split(':', 1)
+        if len(fields) == 2 and fields[0].strip() == interface:
+            counters = fields[1].split()
+            try:
+                return (long(counters[0]), long(counters[8]))
+            except (IndexError, ValueError):
+                return None
+    return None
+
+
+class TrafficMonitor(object):
+
+    """Estimates the throughput on an interface over a sliding window.
+
+    Call sample() at regular intervals; rate() then returns the mean
+    number of bytes per second (in either direction) over the samples
+    taken in the last window seconds.
 
     """
 
-    def __init__(self, modem_proxy):
-        self._modem_proxy = modem_proxy
+    PATH = ProcNetDevProbe.PATH
+    WINDOW = 60  # seconds
 
-    def connect(self, client_id):
-        """Register this client and open the connection if necessary.
+    def __init__(self, interface, window=WINDOW):
+        self._interface = interface
+        self._window = window
+        self._samples = collections.deque()  # (time, total bytes)
 
-        Always returns True.
+    def reset(self):
+        self._samples.clear()
 
-        """
-        log.info('%s connected' % client_id)
-        self._modem_proxy.add_client(client_id)
-        return xmlrpclib.True
+    def sample(self):
+        counters = read_interface_counters(self._interface, self.PATH)
+        if counters is None:
+            self.reset()
+            return
+        now = monotonic()
+        total = counters[0] + counters[1]
+        if self._samples and total < self._samples[-1][1]:
+            self.reset()  # the counters have wrapped or been reset
+        self._samples.append((now, total))
+        while len(self._samples) > 2 and \
+                  now - self._samples[1][0] >= self._window:
+            self._samples.popleft()
 
-    def disconnect(self, client_id, all=xmlrpclib.False):
-        """Disconnect this client and/or close the connection.
+    def rate(self):
+        """Return bytes per second, or None until there are two samples."""
+        if len(self._samples) < 2:
+            return None
+        (first_time, first_total), (last_time, last_total) = \
+            self._samples[0], self._samples[-1]
+        if last_time <= first_time:
+            return None
+        return (last_total - first_total) / (last_time - first_time)
 
-        Always returns True.
 
-        The client argument should uniquely identify the client, and
-        should be usable as a dictionary key.
+class IoctlProbe(object):
 
-        """
-        message = '%s disconnected' % client_id
-        if bool(all):
-            message += ' (all users)'
-        log.info(message)
-        self._modem_proxy.remove_client(client_id)
-        if bool(all):
-            self._modem_proxy.disconnect()
-        return xmlrpclib.True
-                
-    def get_status(self, client_id):
-        """Returns the number of clients and connection status.
+    """Checks the link by asking the kernel for the interface address.
 
-        The values returned are:
+    This is the in-process equivalent of the default is_connected
+    command, which greps ifconfig output for "inet addr".
 
-        current_clients    -- The number of users sharing the connection
-        is_connected       -- True if connected, False otherwise
-        seconds_connected  -- Number of seconds connected
+    """
 
-        """
-        self._modem_proxy.refresh_client(client_id)
-        return (self._modem_proxy.count_clients(),
-                self._modem_proxy.is_connected(),
-                self._modem_proxy.get_time_connected())
-    
+    SIOCGIFADDR = 0x8915
 
-class AutoDisconnectThread(threading.Thread):
+    def __init__(self, config_parser, section=None):
+        interface = get_interface(config_parser, section)
+        self._request = struct.pack('256s', interface[:15])
 
-    INTER_CHECK_PERIOD = 5  # seconds
+    def __call__(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            try:
+                fcntl.ioctl(sock.fileno(), self.SIOCGIFADDR, self._request)
+                return True
+            except IOError:
+                return False
+        finally:
+            sock.close()
 
-    def __init__(self, modem_proxy):
-        threading.Thread.__init__(self)
-        self._modem_proxy = modem_proxy
-        self.finished = threading.Event()
-        self.setDaemon(True)
-        self.setName('AutoDisconnect')
 
-    def run(self):
-        proxy = self._modem_proxy
-        while not self.finished.isSet():
-            proxy.remove_old_clients()
-            self.finished.wait(self.INTER_CHECK_PERIOD)
+LINK_PROBES = {
+    'command': CommandProbe,
+    'sysfs': SysfsProbe,
+    'procfs': ProcNetDevProbe,
+    'ioctl': IoctlProbe,
+}
 
 
-class ReusableSimpleXMLRPCServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+def get_link_option(config_parser, section, option, default):
+    """Return an option from a [link:NAME] section or from [general].
 
-     allow_reuse_address = True
+    section is None for the modem configured in [commands] and
+    [general], which is used when there are no [link:NAME] sections.
 
- 
-class App(object):
+    """
+    if section is not None and config_parser.has_option(section, option):
+        return config_parser.get(section, option)
+    return get_option(config_parser, 'general', option, default)
 
-    def __init__(self):
-        self._become_daemon = True
-        self._config = self._load_config_file()
-        modem = Modem(self._config)
-        self._modem_proxy = ModemProxy(modem)
 
-    def _load_config_file(self):
+def get_interface(config_parser, section=None):
+    """Return the name of the network interface used by the modem."""
+    return get_link_option(config_parser, section, 'interface', 'ppp0')
+
+
+def make_link_probe(config_parser, section=None):
+    """Return the link probe selected in the config file."""
+    name = get_link_option(config_parser, section, 'link_probe', 'command')
+    try:
+        probe_class = LINK_PROBES[name]
+    except KeyError:
+        raise ValueError('unknown link_probe: %s' % name)
+    return probe_class(config_parser, section)
+
+
+class NeedsShell(Exception):
+
+    """Raised by Command for syntax that only /bin/sh understands."""
+
+
+class Command(object):
+
+    """A command from the config file, split into argv lists once.
+
+    Simple commands, pipelines and redirections to and from files (as
+    in the default is_connected command) are started directly, with
+    no /bin/sh to parse them each time. Commands that use any other
+    shell syntax, such as variables, wildcards, lists or builtins, are
+    passed to /bin/sh as they always were.
+
+    """
+
+    TOKEN = re.compile(r"""\s*(?:
+                               (2>&1|[12]?>>?|<|\|)   # operator
+                             | ((?:[^\s'"\\|<>]     # or a word
+                                 | \\.
+                                 | '[^']*'
+                                 | "(?:[^"\\]|\\.)*")+)
+                           )""", re.VERBOSE)
+    SPECIAL = '$`;&(){}*?[]~#!'
+    BUILTINS = ['.', ':', 'alias', 'case', 'cd', 'eval', 'exec', 'exit',
+                'export', 'for', 'if', 'read', 'return', 'set', 'shift',
+                'source', 'trap', 'ulimit', 'umask', 'unset', 'until',
+                'wait', 'while']
+    MODES = {'<': 'r', '>': 'w', '>>': 'a', '1>': 'w', '1>>': 'a',
+             '2>': 'w', '2>>': 'a'}
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
         try:
-            config = ConfigParser.ConfigParser()
-            config.read(['/usr/local/etc/landiallerd.conf',
-                         '/etc/landiallerd.conf',
-                         'landiallerd.conf'])
-            return config
-        except Exception, e:
-            print 'Terminating - error reading config file: %s' % e
-            sys.exit()
+            self.pipeline = self._parse(str(text).strip())
+        except NeedsShell:
+            self.pipeline = None
+
+    def _parse(self, text):
+        # Returns a list of (argv, redirections) for each command in
+        # the pipeline, or raises NeedsShell.
+        pipeline = []
+        argv, redirections = [], []
+        redirection = None
+        pos = 0
+        while pos < len(text):
+            match = self.TOKEN.match(text, pos)
+            if match is None:
+                raise NeedsShell(text)
+            pos = match.end()
+            operator, word = match.groups()
+            if word is not None:
+                if not argv and redirection is None and '=' in word:
+                    raise NeedsShell(text)  # a variable assignment
+                if redirection is not None:
+                    redirections.append((redirection, self._unquote(word)))
+                    redirection = None
+                else:
+                    argv.append(self._unquote(word))
+            elif redirection is not None:
+                raise NeedsShell(text)
+            elif operator == '|':
+                if not argv:
+                    raise NeedsShell(text)
+                pipeline.append((argv, redirections))
+                argv, redirections = [], []
+            elif operator == '2>&1':
+                redirections.append((operator, None))
+            elif (operator in ('>', '>>', '1>', '1>>') and
+                  ('2>&1', None) in redirections):
+                # stderr goes to the stdout from before this redirection,
+                # which subprocess.STDOUT can't express.
+                raise NeedsShell(text)
+            else:
+                redirection = operator
+        if not argv or redirection is not None:
+            raise NeedsShell(text)
+        pipeline.append((argv, redirections))
+        for argv, redirections in pipeline:
+            if argv[0] in self.BUILTINS:
+                raise NeedsShell(text)
+        return pipeline
+
+    def _unquote(self, word):
+        chars = []
+        i = 0
+        while i < len(word):
+            c = word[i]
+            if c == '\\':
+                chars.append(word[i + 1])
+                i += 2
+            elif c == "'":
+                end = word.index("'", i + 1)
+                chars.append(word[i + 1:end])
+                i = end + 1
+            elif c == '"':
+                i += 1
+                while word[i] != '"':
+                    if word[i] in '$`':
+                        raise NeedsShell(word)
+                    if word[i] == '\\' and word[i + 1] in '$`"\\':
+                        i += 1
+                    chars.append(word[i])
+                    i += 1
+                i += 1
+            elif c in self.SPECIAL:
+                raise NeedsShell(word)
+            else:
+                chars.append(c)
+                i += 1
+        return ''.join(chars)
+
+    def spawn(self, new_group=False):
+        """Start the command and return a list of its processes.
+
+        With new_group the processes are put in a process group of
+        their own, led by the first of them, so that they can be
+        signalled together. Raises OSError or IOError if a program
+        can't be started or a file can't be opened.
 
-    def check_platform(self):
-        if os.name != "posix":
-            print "Sorry, only POSIX compliant systems are supported."
-            sys.exit()
+        """
+        if self.pipeline is None:
+            preexec_fn = None
+            if new_group:
+                preexec_fn = os.setpgrp
+            processes = [subprocess.Popen(self.text, shell=True,
+                                          close_fds=True,
+                                          preexec_fn=preexec_fn)]
+        else:
+            processes = self._spawn_pipeline(new_group)
+        metrics.inc('landialler_processes_started_total',
+                    (('command', self.name),), len(processes))
+        return processes
+
+    def _spawn_pipeline(self, new_group):
+        processes = []
+        for argv, redirections in self.pipeline:
+            pipe = stdin = None
+            if processes:
+                pipe = stdin = processes[-1].stdout
+            stdout = subprocess.PIPE
+            if len(processes) == len(self.pipeline) - 1:
+                stdout = None
+            stderr = None
+            files = []
+            try:
+                for operator, path in redirections:
+                    if operator == '2>&1':
+                        stderr = subprocess.STDOUT
+                        continue
+                    f = open(path, self.MODES[operator])
+                    files.append(f)
+                    if operator == '<':
+                        stdin = f
+                    elif operator.startswith('2'):
+                        stderr = f
+                    else:
+                        stdout = f
+                preexec_fn = None
+                if new_group and not processes:
+                    preexec_fn = os.setpgrp
+                elif new_group:
+                    pgid = processes[0].pid
+                    preexec_fn = lambda: os.setpgid(0, pgid)
+                processes.append(subprocess.Popen(argv, stdin=stdin,
+                                                  stdout=stdout,
+                                                  stderr=stderr,
+                                                  close_fds=True,
+                                                  preexec_fn=preexec_fn))
+            finally:
+                # The children have their own copies of these now.
+                for f in files:
+                    f.close()
+                if pipe is not None:
+                    pipe.close()
+        return processes
 
-    def daemonise(self):
-        """Become a daemon process (POSIX only)."""
-        if not self._become_daemon:
+    def run(self):
+        """Run the command, wait for it and return its exit status.
+
+        As with the shell, the status of a pipeline is that of its
+        last command.
+
+        """
+        try:
+            processes = self.spawn()
+        except (OSError, IOError), e:
+            log.warn('%s command failed: %s' % (self.name, e))
+            return 127
+        for process in processes:
+            process.wait()
+        return processes[-1].returncode
+
+
+class ChildProcess(object):
+
+    """A command started by a CommandRunner."""
+
+    def __init__(self, name, command):
+        self.name = name
+        self.started = time.time()
+        self.killed_at = None
+        if isinstance(command, basestring):
+            command = Command(name, command)
+        try:
+            self._processes = command.spawn(new_group=True)
+            self.pid = self._processes[0].pid
+        except (OSError, IOError), e:
+            log.warn('%s command failed: %s' % (name, e))
+            self._processes = []
+            self.pid = None
+
+    def poll(self):
+        """Return the exit status, or None if still running."""
+        if not self._processes:
+            return 127
+        for process in self._processes:
+            if process.poll() is None:
+                return None
+        return self._processes[-1].returncode
+
+    def kill(self, sig):
+        """Send a signal to the command and any processes it started."""
+        if self.pid is None:
             return
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass
 
-        # See "Python Standard Library", pg. 29, O'Reilly, for more
-        # info on the following.
-        pid = os.fork()
-        if pid:  # we're the parent if pid is set
-            os._exit(0)
 
-        os.setpgrp()
-        os.umask(0)
+class CommandRunner(object):
 
-        class DevNull:
+    """Runs commands in the background and keeps track of them.
 
-            def write(self, message):
-                pass
-            
-        sys.stdin.close()
-        sys.stdout = DevNull()
-        sys.stderr = DevNull()
+    Commands are not waited for when they are started. Call reap()
+    regularly to collect their exit status and to kill any that are
+    still running after timeout seconds (SIGTERM first, followed by
+    SIGKILL if they ignore it).
 
-    def getopt(self):
-        opts, args = getopt.getopt(sys.argv[1:], "dfhl:s")
+    """
 
-        for o, v in opts:
-            if o == "-f":
-                self._become_daemon = False
+    TIMEOUT = 60  # seconds
+    KILL_GRACE = 5
 
-    def main(self):
-        log.info('Starting')
-        self.check_platform()
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self._children = []
+        self._lock = threading.Lock()
+
+    def run(self, name, command):
+        """Start command in the background and return its ChildProcess."""
+        child = ChildProcess(name, command)
+        self._lock.acquire()
         try:
-            self.getopt()
-            self.daemonise()
-        except getopt.GetoptError, e:
-            sys.stderr.write("%s\n" % e)
-        
-        thread = AutoDisconnectThread(self._modem_proxy)
-        thread.start()
+            self._children.append(child)
+        finally:
+            self._lock.release()
+        return child
+
+    def count_running(self):
+        return len(self._children)
+
+    def reap(self):
+        """Collect finished commands and kill those that have hung."""
+        self._lock.acquire()
+        try:
+            children = self._children[:]
+        finally:
+            self._lock.release()
+        now = time.time()
+        for child in children:
+            status = child.poll()
+            if status is not None:
+                if status != 0:
+                    log.warn('%s command exited with status %s' %
+                             (child.name, status))
+                self._lock.acquire()
+                try:
+                    self._children.remove(child)
+                finally:
+                    self._lock.release()
+            elif child.killed_at is None:
+                if now - child.started > self.timeout:
+                    log.warn('%s command timed out, killing pid %s' %
+                             (child.name, child.pid))
+                    child.killed_at = now
+                    child.kill(signal.SIGTERM)
+            elif now - child.killed_at > self.KILL_GRACE:
+                child.kill(signal.SIGKILL)
+
+
+class LinkCommands(object):
+
+    """The commands for a link, read from the config file in one go.
+
+    A Modem replaces its LinkCommands as a whole when the config file
+    is reloaded, so that it never mixes old and new commands.
+
+    """
+
+    def __init__(self, config_parser, section=None, probe=None):
+        self.connect = Command('connect',
+                               config_parser.get(section or 'commands',
+                                                 'connect'))
+        self.disconnect = Command('disconnect',
+                                  config_parser.get(section or 'commands',
+                                                    'disconnect'))
+        if probe is None:
+            probe = make_link_probe(config_parser, section)
+        self.probe = probe
+
+
+class Modem(object):
 
-        addr = ('', self._config.getint('general', 'port'))
-        server = ReusableSimpleXMLRPCServer(addr, logRequests=False)
-        server.allow_reuse_address = True
-        server.register_instance(API(self._modem_proxy))
+    def __init__(self, config_parser, probe=None, runner=None, section=None):
+        self.section = section
+        self.commands = LinkCommands(config_parser, section, probe)
+        if runner is None:
+            runner = CommandRunner()
+        self.runner = runner
+        self.timer = Timer()
+
+    def configure(self, config_parser):
+        """Switch to the commands in a reloaded config file."""
+        commands = LinkCommands(config_parser, self.section)
+        timeout = get_option(config_parser, 'general', 'command_timeout',
+                             CommandRunner.TIMEOUT, float)
+        self.commands = commands
+        self.runner.timeout = timeout
+
+    def connect(self):
+        log.info('Connecting')
+        self.timer.reset()
+        self.runner.run('connect', self.commands.connect)
+
+    def disconnect(self):
+        log.info('Disconnecting, online for %s seconds' %
+                 self.timer.elapsed_seconds)
+        self.timer.stop()
+        self.runner.run('disconnect', self.commands.disconnect)
+
+    def reap_commands(self):
+        self.runner.reap()
+
+    def count_running_commands(self):
+        return self.runner.count_running()
+
+    def is_connected(self):
+        started = time.time()
+        try:
+            is_connected = self.commands.probe()
+        finally:
+            metrics.observe('landialler_link_probe_seconds',
+                            time.time() - started)
+        if is_connected:
+            if not self.timer.is_running:
+                self.timer.start()
+            return True
+        else:
+            return False
+
+
+class ModemPool(object):
+
+    """Scales the number of links up and down with the number of clients.
+
+    The pool stands in for a single Modem, and should also be set as
+    the ModemProxy's links attribute so that it hears about clients.
+    The first link is dialled in the usual way. Whenever every link
+    that is up would be carrying clients_per_link clients another link
+    is brought up, and once the clients would fit on one link fewer
+    the last link to come up is hung up.
+
+    The pool only decides how many links are up. Spreading the
+    traffic over them is left to the routing set up by the links'
+    connect commands (e.g. a multipath default route).
+
+    """
+
+    CLIENTS_PER_LINK = 10
+
+    def __init__(self, links, clients_per_link=CLIENTS_PER_LINK):
+        self._names = [name for name, modem in links]
+        self._modems = [modem for name, modem in links]
+        self.clients_per_link = max(1, clients_per_link)
+        self._active = 0  # links are brought up in order
+        self._clients = {}
+        self._is_first_probe = True
+        self._lock = threading.RLock()
+
+    def _get_timer(self):
+        return self._modems[0].timer
+
+    timer = property(_get_timer)
+
+    def _wanted_links(self):
+        wanted = -(-len(self._clients) // self.clients_per_link)
+        return min(max(1, wanted), len(self._modems))
+
+    def _balance(self):
+        wanted = self._wanted_links()
+        while self._active < wanted:
+            log.info('Bringing up link %s' % self._names[self._active])
+            self._modems[self._active].connect()
+            self._active += 1
+        while self._active > wanted:
+            self._active -= 1
+            log.info('Taking down link %s' % self._names[self._active])
+            self._modems[self._active].disconnect()
+
+    def add_client(self, client_id):
+        self._lock.acquire()
+        try:
+            if client_id not in self._clients:
+                self._clients[client_id] = True
+                if self._active:
+                    self._balance()
+        finally:
+            self._lock.release()
+
+    def remove_client(self, client_id):
+        self._lock.acquire()
+        try:
+            if self._clients.pop(client_id, None) is not None:
+                if self._active:
+                    self._balance()
+        finally:
+            self._lock.release()
+
+    def count_active_links(self):
+        return self._active
+
+    def configure(self, config_parser):
+        """Switch every link to the commands in a reloaded config file."""
+        names = [section[len('link:'):]
+                 for section in config_parser.sections()
+                 if section.startswith('link:')]
+        if names != self._names:
+            log.warn('Links can only be added or removed by restarting')
+        commands = [LinkCommands(config_parser, modem.section)
+                    for modem in self._modems]
+        timeout = get_option(config_parser, 'general', 'command_timeout',
+                             CommandRunner.TIMEOUT, float)
+        clients_per_link = get_option(config_parser, 'general',
+                                      'clients_per_link',
+                                      self.CLIENTS_PER_LINK, int)
+        for modem, link_commands in zip(self._modems, commands):
+            modem.commands = link_commands
+            modem.runner.timeout = timeout
+        self.clients_per_link = max(1, clients_per_link)
+
+    def connect(self):
+        self._lock.acquire()
+        try:
+            self._modems[0].connect()
+            self._active = max(1, self._active)
+            self._balance()
+        finally:
+            self._lock.release()
+
+    def disconnect(self):
+        self._lock.acquire()
+        try:
+            while self._active > 1:
+                self._active -= 1
+                self._modems[self._active].disconnect()
+            self._modems[0].disconnect()
+            self._active = 0
+        finally:
+            self._lock.release()
+
+    def reap_commands(self):
+        for modem in self._modems:
+            modem.reap_commands()
+
+    def count_running_commands(self):
+        return sum([modem.count_running_commands() for modem in self._modems])
+
+    def is_connected(self):
+        # Links are probed outside the lock as probes may be slow.
+        if self._is_first_probe:
+            self._take_over_links()
+        links = self._modems[:max(1, self._active)]
+        return True in [modem.is_connected() for modem in links]
+
+    def _take_over_links(self):
+        # After a restart the pool doesn't know which links it brought
+        # up, so it takes over those that are already connected.
+        count = 0
+        while count < len(self._modems):
+            if not self._modems[count].is_connected():
+                break
+            count += 1
+        self._lock.acquire()
+        try:
+            if self._is_first_probe and not self._active:
+                self._active = count
+            self._is_first_probe = False
+        finally:
+            self._lock.release()
+
+
+class RegistryFull(Exception):
+
+    """Raised when a new client would exceed the maximum allowed."""
+
+
+class ClientRecord(object):
+
+    """What we know about a client."""
+
+    __slots__ = ('client_id', 'address', 'first_seen', 'last_seen', 'polls')
+
+    def __init__(self, client_id, address, now):
+        self.client_id = client_id
+        self.address = address
+        self.first_seen = now
+        self.last_seen = now
+        self.polls = 0
+
+
+def encode_client_id(client_id):
+    """Return client_id as a byte string, e.g. for saving to disk."""
+    if isinstance(client_id, unicode):
+        return client_id.encode('utf-8')
+    return str(client_id)
+
+
+def decode_client_id(text):
+    """Return the client id saved as text by encode_client_id().
+
+    xmlrpclib only gives us unicode ids when they aren't plain ASCII,
+    so only those are decoded.
+
+    """
+    try:
+        text.decode('ascii')
+        return text
+    except UnicodeError:
+        try:
+            return text.decode('utf-8')
+        except UnicodeError:
+            return text
+
+
+class ClientRegistry(object):
+
+    """Keeps track of clients and works out when they've timed out.
+
+    Times come from the monotonic() clock, so setting the system clock
+    doesn't make clients appear to have gone away. A heap of expiry
+    times means that finding timed out clients only touches those that
+    have actually expired.
+
+    The registry doesn't do any locking of its own.
+
+    """
+
+    MAX_CLIENTS = 1024
+
+    def __init__(self, timeout, max_clients=None):
+        self.timeout = timeout
+        if max_clients is None:
+            max_clients = self.MAX_CLIENTS
+        self.max_clients = max_clients
+        self._records = {}
+        self._expiry = []  # heap of (last_seen, client_id)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, client_id):
+        return client_id in self._records
+
+    def get(self, client_id):
+        return self._records.get(client_id)
+
+    def touch(self, client_id, address=None):
+        """Record that we've heard from a client, adding it if new."""
+        now = monotonic()
+        record = self._records.get(client_id)
+        if record is None:
+            if len(self._records) >= self.max_clients:
+                raise RegistryFull(client_id)
+            record = ClientRecord(client_id, address, now)
+            self._records[client_id] = record
+        else:
+            record.last_seen = now
+            if address is not None:
+                record.address = address
+        record.polls += 1
+        heapq.heappush(self._expiry, (now, client_id))
+        if len(self._expiry) > 2 * len(self._records) + 64:
+            self._expiry = [(r.last_seen, r.client_id)
+                            for r in self._records.values()]
+            heapq.heapify(self._expiry)
+        return record
+
+    def remove(self, client_id):
+        if client_id in self._records:
+            del self._records[client_id]
+
+    def records(self):
+        return self._records.values()
+
+    def restore(self, record):
+        """Add a record saved by a previous process."""
+        if len(self._records) >= self.max_clients:
+            raise RegistryFull(record.client_id)
+        self._records[record.client_id] = record
+        heapq.heappush(self._expiry, (record.last_seen, record.client_id))
+
+    def _drop_stale_expiry_entries(self):
+        # Entries are left in the heap when a client is refreshed or
+        # removed; they're ignored once they reach the top.
+        expiry = self._expiry
+        while expiry:
+            record = self._records.get(expiry[0][1])
+            if record is not None and record.last_seen == expiry[0][0]:
+                break
+            heapq.heappop(expiry)
+
+    def pop_expired(self):
+        """Return the ids of clients that have timed out.
+
+        The clients are left in the registry for the caller to remove.
+
+        """
+        cutoff = monotonic() - self.timeout
+        expired = []
+        self._drop_stale_expiry_entries()
+        while self._expiry and self._expiry[0][0] <= cutoff:
+            expired.append(heapq.heappop(self._expiry)[1])
+            self._drop_stale_expiry_entries()
+        return expired
+
+    def next_expiry(self):
+        """Return seconds until the next client times out, or None."""
+        self._drop_stale_expiry_entries()
+        if not self._expiry:
+            return None
+        return max(0, self._expiry[0][0] + self.timeout - monotonic())
+
+
+class SavedState(object):
+
+    """The state read back from a StateJournal."""
+
+    def __init__(self):
+        self.clients = []
+        self.state = None
+        self.start_time = None
+        self.stop_time = None
+        self.timer_running = False
+
+
+class StateJournal(object):
+
+    """Saves the client table and dialling state across restarts.
+
+    Changes are appended to a journal file as they happen, one per
+    line. They are buffered in memory and written to disk (and
+    fsync'ed) together when sync() is called. Once enough changes have
+    built up the file is replaced by a snapshot of the current state.
+
+    Client times are saved as wall clock times and converted back to
+    the monotonic clock when the journal is loaded.
+
+    """
+
+    COMPACT_AFTER = 1000  # records
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()  # guards _pending
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._records = 0
+
+    def _append(self, line):
+        self._lock.acquire()
+        try:
+            self._pending.append(line)
+        finally:
+            self._lock.release()
+
+    def _client_line(self, record):
+        now_wall, now = time.time(), monotonic()
+        address = record.address or '-'
+        return 'client %s %s %.3f %.3f %d\n' % (
+            urllib.quote(encode_client_id(record.client_id), ''),
+            urllib.quote(address, ''),
+            now_wall - (now - record.first_seen),
+            now_wall - (now - record.last_seen),
+            record.polls)
+
+    def _state_lines(self, state, timer):
+        return ['state %s\n' % urllib.quote(state, ''),
+                'timer %.6f %d %.6f\n' % (timer.start_time,
+                                           timer.is_running,
+                                           timer.stop_time)]
+
+    def client_added(self, record):
+        self._append(self._client_line(record))
+
+    def client_removed(self, client_id):
+        self._append('remove %s\n' %
+                     urllib.quote(encode_client_id(client_id), ''))
+
+    def state_changed(self, state, timer):
+        for line in self._state_lines(state, timer):
+            self._append(line)
+
+    def needs_compacting(self):
+        return self._records > self.COMPACT_AFTER
+
+    def _write(self, path, mode, lines):
+        f = open(path, mode)
+        try:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def sync(self):
+        """Write buffered changes to disk."""
+        self._write_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                pending, self._pending = self._pending, []
+            finally:
+                self._lock.release()
+            if not pending:
+                return
+            try:
+                self._write(self.path, 'a', pending)
+            except:
+                self._lock.acquire()
+                try:
+                    self._pending[:0] = pending
+                finally:
+                    self._lock.release()
+                raise
+            self._records += len(pending)
+        finally:
+            self._write_lock.release()
+
+    def snapshot(self, records, state, timer):
+        """Return a snapshot of the current state for compact().
+
+        Call this while the state can't change; changes buffered so
+        far are covered by the snapshot and are dropped.
+
+        """
+        lines = [self._client_line(record) for record in records]
+        lines.extend(self._state_lines(state, timer))
+        self._lock.acquire()
+        try:
+            self._pending = []
+        finally:
+            self._lock.release()
+        return lines
+
+    def compact(self, snapshot):
+        """Replace the journal with a snapshot from snapshot()."""
+        self._write_lock.acquire()
+        try:
+            temp_path = self.path + '.new'
+            self._write(temp_path, 'w', snapshot)
+            os.rename(temp_path, self.path)
+            self._records = len(snapshot)
+        finally:
+            self._write_lock.release()
+
+    def load(self):
+        """Return the SavedState recorded in the journal."""
+        saved = SavedState()
+        clients = {}
+        try:
+            f = open(self.path)
+        except IOError:
+            return saved
+        now_wall, now = time.time(), monotonic()
+        try:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # partly written by a crash
+                fields = line.split()
+                try:
+                    if fields[0] == 'client':
+                        client_id = decode_client_id(
+                            urllib.unquote(fields[1]))
+                        address = urllib.unquote(fields[2])
+                        if address == '-':
+                            address = None
+                        record = ClientRecord(client_id, address, 0)
+                        record.first_seen = now - (now_wall - float(fields[3]))
+                        record.last_seen = now - (now_wall - float(fields[4]))
+                        record.polls = int(fields[5])
+                        clients[client_id] = record
+                    elif fields[0] == 'remove':
+                        clients.pop(decode_client_id(
+                            urllib.unquote(fields[1])), None)
+                    elif fields[0] == 'state':
+                        saved.state = urllib.unquote(fields[1])
+                    elif fields[0] == 'timer':
+                        saved.start_time = float(fields[1])
+                        saved.timer_running = bool(int(fields[2]))
+                        if len(fields) > 3:
+                            saved.stop_time = float(fields[3])
+                except (IndexError, ValueError):
+                    continue
+        finally:
+            f.close()
+        saved.clients = clients.values()
+        return saved
+
+
+class UsageDatabase(object):
+
+    """Records the time spent on line in an SQLite database.
+
+    Each session is stored along with the clients that shared it and
+    the bytes transferred. Daily and monthly totals are updated as
+    each session is recorded, so queries about usage never need to
+    read the individual sessions. A session that runs past midnight
+    has its time (and bytes, in proportion) split between the days.
+
+    """
+
+    PERIODS = {'day': ('usage_daily', '%Y-%m-%d'),
+               'month': ('usage_monthly', '%Y-%m')}
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            start REAL, end REAL, seconds INTEGER,
+            rx_bytes INTEGER, tx_bytes INTEGER, clients TEXT);
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            period TEXT PRIMARY KEY, sessions INTEGER, seconds INTEGER,
+            rx_bytes INTEGER, tx_bytes INTEGER);
+        CREATE TABLE IF NOT EXISTS usage_monthly (
+            period TEXT PRIMARY KEY, sessions INTEGER, seconds INTEGER,
+            rx_bytes INTEGER, tx_bytes INTEGER);
+        """
+
+    def __init__(self, path):
+        try:
+            connect = sqlite3.connect
+        except ImportError:
+            raise RuntimeError('usage accounting needs the sqlite3 module')
+        self._lock = threading.Lock()
+        self._db = connect(path, check_same_thread=False)
+        self._db.executescript(self.SCHEMA)
+
+    def _split_by_day(self, start, end):
+        # Yields (start, end) for the part of the session on each day.
+        while True:
+            year, month, day = time.localtime(start)[:3]
+            midnight = time.mktime((year, month, day + 1, 0, 0, 0, 0, 0, -1))
+            if end <= midnight:
+                yield start, end
+                return
+            yield start, midnight
+            start = midnight
+
+    def _add_to_rollup(self, table, period, sessions, seconds, rx, tx):
+        self._db.execute('INSERT OR IGNORE INTO %s VALUES (?, 0, 0, 0, 0)'
+                         % table, (period,))
+        self._db.execute('UPDATE %s SET sessions = sessions + ?, '
+                         'seconds = seconds + ?, rx_bytes = rx_bytes + ?, '
+                         'tx_bytes = tx_bytes + ? WHERE period = ?' % table,
+                         (sessions, seconds, rx, tx, period))
+
+    def record_session(self, start, end, rx_bytes, tx_bytes, clients):
+        seconds = int(round(end - start))
+        self._lock.acquire()
+        try:
+            self._db.execute('INSERT INTO sessions (start, end, seconds, '
+                             'rx_bytes, tx_bytes, clients) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (start, end, seconds, rx_bytes, tx_bytes,
+                              ','.join([urllib.quote(encode_client_id(c), '')
+                                        for c in clients])))
+            new_session = 1
+            for part_start, part_end in self._split_by_day(start, end):
+                if end > start:
+                    share = (part_end - part_start) / (end - start)
+                else:
+                    share = 1
+                part = time.localtime(part_start)
+                part_seconds = int(round(part_end - part_start))
+                part_rx = int(round(rx_bytes * share))
+                part_tx = int(round(tx_bytes * share))
+                for table, format in self.PERIODS.values():
+                    self._add_to_rollup(table, time.strftime(format, part),
+                                        new_session, part_seconds,
+                                        part_rx, part_tx)
+                new_session = 0
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def get_usage(self, period, count):
+        """Return totals for the most recent count days or months."""
+        try:
+            table = self.PERIODS[period][0]
+        except KeyError:
+            raise ValueError('unknown period: %s' % period)
+        self._lock.acquire()
+        try:
+            rows = self._db.execute('SELECT period, sessions, seconds, '
+                                    'rx_bytes, tx_bytes FROM %s '
+                                    'ORDER BY period DESC LIMIT ?' % table,
+                                    (count,)).fetchall()
+        finally:
+            self._lock.release()
+        usage = []
+        for name, sessions, seconds, rx_bytes, tx_bytes in rows:
+            usage.append({'period': name, 'sessions': sessions,
+                          'seconds': seconds, 'rx_bytes': float(rx_bytes),
+                          'tx_bytes': float(tx_bytes)})
+        return usage
+
+
+class UsageAccountant(object):
+
+    """Follows the link through each session for the UsageDatabase.
+
+    The session_* methods are called by the ModemProxy with its lock
+    held, so finished sessions are queued and written to the database
+    by a separate thread.
+
+    """
+
+    def __init__(self, database, interface):
+        self._database = database
+        self._interface = interface
+        self._start_time = None
+        self._clients = None
+        self._first_counters = None
+        self._last_counters = None
+        self._sessions = Queue.Queue()
+        self._writer = None
+
+    def sample(self):
+        """Read the interface's byte counters while the link is up."""
+        counters = read_interface_counters(self._interface)
+        if counters is not None:
+            if self._first_counters is None:
+                self._first_counters = counters
+            self._last_counters = counters
+
+    def session_started(self, start_time, client_ids):
+        self._start_time = start_time
+        self._clients = dict.fromkeys(client_ids)
+        self._first_counters = None
+        self._last_counters = None
+        self.sample()
+
+    def client_joined(self, client_id):
+        if self._clients is not None:
+            self._clients[client_id] = None
+
+    def session_ended(self):
+        if self._start_time is None:
+            return
+        self.sample()
+        rx_bytes = tx_bytes = 0
+        if self._first_counters is not None:
+            rx_bytes = max(0, self._last_counters[0] - self._first_counters[0])
+            tx_bytes = max(0, self._last_counters[1] - self._first_counters[1])
+        clients = self._clients.keys()
+        clients.sort()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_sessions,
+                                            name='UsageWriter')
+            self._writer.setDaemon(True)
+            self._writer.start()
+        self._sessions.put((self._start_time, time.time(),
+                            rx_bytes, tx_bytes, clients))
+        self._start_time = None
+        self._clients = None
+
+    def _write_sessions(self):
+        while True:
+            session = self._sessions.get()
+            try:
+                try:
+                    self._database.record_session(*session)
+                except Exception, e:
+                    log.error('Failed to record usage: %s' % e)
+            finally:
+                self._sessions.task_done()
+
+    def flush(self):
+        """Wait until every session ended so far has been recorded."""
+        self._sessions.join()
+
+
+class JournalThread(threading.Thread):
+
+    """Writes the StateJournal to disk every SYNC_PERIOD seconds."""
+
+    SYNC_PERIOD = 1  # seconds
+
+    def __init__(self, modem_proxy, journal):
+        threading.Thread.__init__(self)
+        self._modem_proxy = modem_proxy
+        self._journal = journal
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('Journal')
+
+    def run(self):
+        while not self.finished.isSet():
+            self.finished.wait(self.SYNC_PERIOD)
+            try:
+                if self._journal.needs_compacting():
+                    self._modem_proxy.save(self._journal)
+                else:
+                    self._journal.sync()
+            except Exception, e:
+                log.error('Error writing state file: %s' % e)
+
+
+class ModemProxy(object):
+
+    """Shares the modem between clients.
+
+    The proxy dials when the first client connects and hangs up once
+    the last one has gone. The state attribute follows the link as it
+    moves from IDLE to DIALLING to CONNECTED, and through HANGING_UP
+    back to IDLE again.
+
+    With a hangup_delay the proxy waits that many seconds before
+    hanging up, and stays on line if a client connects in the
+    meantime, so that clients toggling connect and disconnect don't
+    make the modem dial and hang up over and over.
+
+    A dial that hasn't brought the link up within dial_timeout seconds
+    has failed. The proxy then hangs up and dials again after a delay
+    that starts at redial_delay seconds and doubles with each attempt
+    (up to max_redial_delay, with some random jitter so that several
+    servers sharing a line don't retry in step). After max_dial_attempts
+    it gives up and goes back to IDLE, and the next client to connect
+    starts again.
+
+    """
+
+    CLIENT_TIMEOUT = 30
+    DIAL_TIMEOUT = 90
+    MAX_DIAL_ATTEMPTS = 5
+    REDIAL_DELAY = 10
+    MAX_REDIAL_DELAY = 300
+
+    IDLE = 'idle'
+    DIALLING = 'dialling'
+    CONNECTED = 'connected'
+    HANGING_UP = 'hanging up'
+
+    def __init__(self, modem, status_ttl=0,
+                 max_clients=None):
+        self._modem = modem
+        self._clients = ClientRegistry(self.CLIENT_TIMEOUT, max_clients)
+        self.state = self.IDLE
+        self._lock = threading.RLock()
+        self._link_state = LinkStateCache(self._probe_modem, status_ttl)
+        self.is_monitored = False
+        self._status = (0, False, 0)
+        self._status_version = 1
+        self._status_changed = threading.Condition(self._lock)
+        self.journal = None
+        self.accounting = None
+        self.links = None
+        self.wakeup = None  # called when a new deadline is set
+        self.hangup_delay = 0
+        self._hangup_at = None
+        self.dial_timeout = self.DIAL_TIMEOUT
+        self.max_dial_attempts = self.MAX_DIAL_ATTEMPTS
+        self.redial_delay = self.REDIAL_DELAY
+        self.max_redial_delay = self.MAX_REDIAL_DELAY
+        self._dial_attempt = 0
+        self._dial_deadline = None
+        self._redial_at = None
+
+    def _check_link(self):
+        # Called without the lock held, so that a slow is_connected
+        # command doesn't hold up clients that only need the lock. A
+        # LinkMonitorThread's snapshot is used rather than probing.
+        if self.is_monitored:
+            return self._status[1]
+        return self.is_connected()
+
+    def add_client(self, client_id, address=None):
+        is_connected = self._check_link()
+        self._lock.acquire()
+        try:
+            if client_id not in self._clients:
+                self._client_added(self._clients.touch(client_id, address))
+            if self._hangup_at is not None:
+                log.info('Staying on line, hangup cancelled')
+                self._hangup_at = None
+            if not is_connected and self.state == self.IDLE:
+                self._set_state(self.DIALLING)
+                self._dial_attempt = 0
+                self._dial()
+            self._publish_status()
+        finally:
+            self._lock.release()
+
+    def refresh_client(self, client_id, address=None):
+        self._lock.acquire()
+        try:
+            is_new = client_id not in self._clients
+            try:
+                record = self._clients.touch(client_id, address)
+            except RegistryFull:
+                return
+            if is_new:
+                self._client_added(record)
+            if is_new:
+                self._publish_status()
+        finally:
+            self._lock.release()
+
+    def refresh_clients(self, client_ids, address=None):
+        """Refresh several clients while holding the lock just once."""
+        self._lock.acquire()
+        try:
+            for client_id in client_ids:
+                self.refresh_client(client_id, address)
+        finally:
+            self._lock.release()
+
+    def _forget_client(self, client_id):
+        if client_id in self._clients:
+            if self.journal is not None:
+                self.journal.client_removed(client_id)
+            if self.links is not None:
+                self.links.remove_client(client_id)
+        self._clients.remove(client_id)
+        self._publish_status()
+
+    def _hang_up_if_unused(self):
+        is_connected = self._check_link()
+        self._lock.acquire()
+        try:
+            if not self._clients:
+                if is_connected or self.state == self.DIALLING:
+                    self.hang_up()
+        finally:
+            self._lock.release()
+
+    def remove_client(self, client_id):
+        self._lock.acquire()
+        try:
+            self._forget_client(client_id)
+        finally:
+            self._lock.release()
+        if not self._clients:
+            self._hang_up_if_unused()
+
+    def remove_old_clients(self):
+        started = time.time()
+        self._lock.acquire()
+        try:
+            expired = self._clients.pop_expired()
+            for client_id in expired:
+                self._forget_client(client_id)
+        finally:
+            self._lock.release()
+        if expired and not self._clients:
+            self._hang_up_if_unused()
+        metrics.observe('landialler_expiry_sweep_seconds',
+                        time.time() - started)
+
+    def next_expiry(self):
+        """Return seconds until the next client times out (or a delayed
+        hangup or redial is due), or None."""
+        self._lock.acquire()
+        try:
+            delay = self._clients.next_expiry()
+            for deadline in (self._hangup_at, self._dial_deadline,
+                             self._redial_at):
+                if deadline is not None:
+                    remaining = max(0, deadline - monotonic())
+                    if delay is None or remaining < delay:
+                        delay = remaining
+            return delay
+        finally:
+            self._lock.release()
+
+    def _dial(self):
+        self._dial_attempt += 1
+        self._redial_at = None
+        if self.dial_timeout > 0:
+            self._dial_deadline = monotonic() + self.dial_timeout
+            self._deadline_set()
+        self._link_state.invalidate()
+        metrics.inc('landialler_dial_attempts_total')
+        self._modem.connect()
+
+    def _redial_delay(self):
+        delay = min(self.max_redial_delay,
+                    self.redial_delay * 2 ** (self._dial_attempt - 1))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def check_dialling(self):
+        """Notice failed dials and redial when the time comes."""
+        if self.state != self.DIALLING:
+            return
+        self.is_connected()  # moves us on to CONNECTED if the link is up
+        self._lock.acquire()
+        try:
+            if self.state != self.DIALLING:
+                return
+            now = monotonic()
+            if self._redial_at is not None and now >= self._redial_at:
+                log.info('Redialling (attempt %d of %d)' %
+                         (self._dial_attempt + 1, self.max_dial_attempts))
+                self._dial()
+            elif self._dial_deadline is not None and \
+                     now >= self._dial_deadline:
+                metrics.inc('landialler_dial_failures_total')
+                self._dial_deadline = None
+                self._modem.disconnect()
+                if self._dial_attempt >= self.max_dial_attempts:
+                    log.error('Giving up after %d failed dial attempts' %
+                              self._dial_attempt)
+                    self._dial_attempt = 0
+                    self._set_state(self.IDLE)
+                else:
+                    delay = self._redial_delay()
+                    log.warn('Dial attempt %d failed, redialling in %d '
+                             'seconds' % (self._dial_attempt, delay))
+                    self._redial_at = now + delay
+        finally:
+            self._lock.release()
+
+    def get_dial_status(self):
+        """Return the dial attempt and seconds until the next redial.
+
+        The attempt is 0 when not dialling; the seconds are None if no
+        redial is waiting.
+
+        """
+        self._lock.acquire()
+        try:
+            attempt = 0
+            if self.state == self.DIALLING:
+                attempt = self._dial_attempt
+            redial_in = None
+            if self._redial_at is not None:
+                redial_in = max(0, self._redial_at - monotonic())
+            return attempt, redial_in
+        finally:
+            self._lock.release()
+
+    def get_client(self, client_id):
+        """Return the ClientRecord for client_id, or None."""
+        return self._clients.get(client_id)
+
+    def client_ids(self):
+        self._lock.acquire()
+        try:
+            return [record.client_id for record in self._clients.records()]
+        finally:
+            self._lock.release()
+
+    def _set_state(self, state):
+        previous, self.state = self.state, state
+        if self.journal is not None:
+            self.journal.state_changed(state, self._modem.timer)
+        if self.accounting is not None:
+            if state == self.CONNECTED:
+                self.accounting.session_started(self._modem.timer.start_time,
+                                                self.client_ids())
+            elif previous == self.CONNECTED:
+                self.accounting.session_ended()
+
+    def _client_added(self, record):
+        if self.links is not None:
+            self.links.add_client(record.client_id)
+        if self.journal is not None:
+            self.journal.client_added(record)
+        if self.accounting is not None:
+            self.accounting.client_joined(record.client_id)
+
+    def save(self, journal):
+        """Write the current state to journal as a snapshot."""
+        self._lock.acquire()
+        try:
+            snapshot = journal.snapshot(self._clients.records(), self.state,
+                                        self._modem.timer)
+        finally:
+            self._lock.release()
+        journal.compact(snapshot)  # the slow part, so outside the lock
+
+    def restore(self, saved):
+        """Take up where a previous process left off.
+
+        Polls aren't journalled, so restored clients are treated as
+        having been seen just now and get a full CLIENT_TIMEOUT to
+        poll the new process.
+
+        """
+        now = monotonic()
+        self._lock.acquire()
+        try:
+            for record in saved.clients:
+                record.last_seen = now
+                try:
+                    self._clients.restore(record)
+                except RegistryFull:
+                    break
+                if self.links is not None:
+                    self.links.add_client(record.client_id)
+            if saved.state is not None:
+                self.state = saved.state
+            if self.state == self.DIALLING:
+                # We can't tell how long the dial has been going, so
+                # it gets a full dial_timeout from now.
+                self._dial_attempt = 1
+                if self.dial_timeout > 0:
+                    self._dial_deadline = now + self.dial_timeout
+            if saved.start_time is not None:
+                self._modem.timer.restore(saved.start_time,
+                                          saved.timer_running,
+                                          saved.stop_time)
+        finally:
+            self._lock.release()
+
+    def count_clients(self):
+        return len(self._clients)
+
+    def configure(self, status_ttl, max_clients):
+        """Change the settings given to the constructor."""
+        self._link_state.ttl = status_ttl
+        self._clients.max_clients = max_clients
+
+    def _probe_modem(self):
+        return bool(self._modem.is_connected())
+
+    def is_connected(self):
+        # Must be called without the lock held (see _check_link()).
+        is_connected = self._link_state.get()
+        self._lock.acquire()
+        try:
+            if is_connected:
+                if self.state == self.DIALLING:
+                    metrics.inc('landialler_dial_successes_total')
+                    self._dial_deadline = self._redial_at = None
+                if self.state in (self.IDLE, self.DIALLING):
+                    self._set_state(self.CONNECTED)
+            elif self.state in (self.CONNECTED, self.HANGING_UP):
+                self._set_state(self.IDLE)
+        finally:
+            self._lock.release()
+        return is_connected
+
+    def get_time_connected(self):
+        return self._modem.timer.elapsed_seconds
+
+    def hang_up(self):
+        """Disconnect once hangup_delay seconds have passed."""
+        self._lock.acquire()
+        try:
+            if self.hangup_delay <= 0:
+                self.disconnect()
+            elif self._hangup_at is None:
+                self._hangup_at = monotonic() + self.hangup_delay
+                self._deadline_set()
+        finally:
+            self._lock.release()
+
+    def _deadline_set(self):
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def hang_up_if_due(self):
+        self._lock.acquire()
+        try:
+            if self._hangup_at is not None and monotonic() >= self._hangup_at:
+                self.disconnect()
+        finally:
+            self._lock.release()
+
+    def disconnect(self):
+        self._lock.acquire()
+        try:
+            self._hangup_at = None
+            self._dial_deadline = self._redial_at = None
+            self._link_state.invalidate()
+            self._modem.disconnect()
+            self._set_state(self.HANGING_UP)
+        finally:
+            self._lock.release()
+
+    def reap_commands(self):
+        """Tidy up after connect and disconnect commands."""
+        self._modem.reap_commands()
+
+    def count_running_commands(self):
+        return self._modem.count_running_commands() or 0
+
+    def _publish_status(self, is_connected=None):
+        # Without is_connected only the client count has changed, and
+        # the rest of the snapshot is kept until the link is checked.
+        if is_connected is None:
+            status = (self.count_clients(),) + self._status[1:]
+        else:
+            status = (self.count_clients(), is_connected,
+                      self.get_time_connected())
+        if status[:2] != self._status[:2]:
+            self._status_version += 1
+            self._status_changed.notifyAll()
+        self._status = status
+
+    def update_status(self):
+        """Probe the link and publish a new status snapshot."""
+        is_connected = self.is_connected()
+        self._lock.acquire()
+        try:
+            if is_connected and self.accounting is not None:
+                self.accounting.sample()
+            self._publish_status(is_connected)
+        finally:
+            self._lock.release()
+
+    def get_status(self):
+        """Return (current_clients, is_connected, seconds_connected).
+
+        When the link is being watched by a LinkMonitorThread the
+        latest snapshot is returned without probing the link.
+
+        """
+        if not self.is_monitored:
+            self.update_status()
+        return self._status
+
+    def wait_for_status_change(self, last_version, timeout):
+        """Wait for the status to change from last_version.
+
+        Returns (version, current_clients, is_connected,
+        seconds_connected) as soon as the number of clients or the
+        state of the link differs from the status that was current at
+        last_version, or after timeout seconds if it doesn't.
+
+        """
+        if not self.is_monitored:
+            self.update_status()
+        self._lock.acquire()
+        try:
+            deadline = monotonic() + timeout
+            while self._status_version == last_version:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._status_changed.wait(remaining)
+            return (self._status_version,) + self._status
+        finally:
+            self._lock.release()
+
+
+class RateLimiter(object):
+
+    """A token bucket for each client id or address.
+
+    Each key may make burst requests at once, after which it is
+    allowed rate requests per second. Keys whose buckets have filled
+    up again are forgotten once there are more than MAX_KEYS of them,
+    as a full bucket is no different from a new one.
+
+    """
+
+    MAX_KEYS = 4096
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._buckets = {}  # key -> [tokens, time of last request]
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Take a token for key, returning False if there are none."""
+        now = monotonic()
+        self._lock.acquire()
+        try:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_KEYS:
+                    self._forget_idle_keys(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst,
+                                bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _forget_idle_keys(self, now):
+        for key, (tokens, last) in self._buckets.items():
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self._buckets[key]
+
+
+class RateLimited(xmlrpclib.Fault):
+
+    """Returned to clients that are making too many requests."""
+
+    def __init__(self):
+        xmlrpclib.Fault.__init__(self, 4, 'too many requests')
+
+
+class API(object):
+    
+    """Implements the LANdialler API.
+
+    All accessible methods in this class form a part of the LANdialler
+    XML-RPC API, and are called directly whenever a client makes an
+    HTTP request to the server.
+
+    """
+
+    MAX_WAIT = 20  # seconds
+
+    def __init__(self, modem_proxy, max_wait=MAX_WAIT, usage=None):
+        self._modem_proxy = modem_proxy
+        self.max_wait = max_wait
+        self._usage = usage
+        self.client_limiter = None
+        self.address_limiter = None
+
+    def _admit(self, method, client_id=None):
+        # Turns away clients that have used up their RateLimiter tokens
+        # before any real work is done on their behalf.
+        client_ids = []
+        if client_id is not None:
+            client_ids.append(client_id)
+        self._admit_many(method, client_ids)
+
+    def _admit_many(self, method, client_ids):
+        # As _admit(), charging each client in a batch but the address
+        # only once.
+        address = get_client_address()
+        allowed = True
+        if self.client_limiter is not None:
+            for client_id in client_ids:
+                if not self.client_limiter.allow(client_id):
+                    allowed = False
+                    break
+        if (allowed and address is not None and
+            self.address_limiter is not None):
+            allowed = self.address_limiter.allow(address)
+        if not allowed:
+            metrics.inc('landialler_api_rejected_total', (('method', method),))
+            raise RateLimited()
+
+    def _start_call(self, method):
+        metrics.inc('landialler_api_calls_total', (('method', method),))
+        return time.time()
+
+    def _end_call(self, method, started):
+        metrics.observe('landialler_api_call_seconds', time.time() - started,
+                        (('method', method),))
+
+    def connect(self, client_id):
+        """Register this client and open the connection if necessary.
+
+        Always returns True.
+
+        """
+        self._admit('connect', client_id)
+        started = self._start_call('connect')
+        try:
+            log.info('%s connected' % client_id)
+            try:
+                self._modem_proxy.add_client(client_id, get_client_address())
+            except RegistryFull:
+                log.warn('Refusing %s, too many clients' % client_id)
+                raise xmlrpclib.Fault(1, 'too many clients')
+            return xmlrpclib.True
+        finally:
+            self._end_call('connect', started)
+
+    def disconnect(self, client_id, all=xmlrpclib.False):
+        """Disconnect this client and/or close the connection.
+
+        Always returns True.
+
+        The client argument should uniquely identify the client, and
+        should be usable as a dictionary key.
+
+        """
+        self._admit('disconnect', client_id)
+        started = self._start_call('disconnect')
+        try:
+            message = '%s disconnected' % client_id
+            if bool(all):
+                message += ' (all users)'
+            log.info(message)
+            self._modem_proxy.remove_client(client_id)
+            if bool(all):
+                self._modem_proxy.hang_up()
+            return xmlrpclib.True
+        finally:
+            self._end_call('disconnect', started)
+                
+    def get_status(self, client_id):
+        """Returns the number of clients and connection status.
+
+        The values returned are:
+
+        current_clients    -- The number of users sharing the connection
+        is_connected       -- True if connected, False otherwise
+        seconds_connected  -- Number of seconds connected
+
+        """
+        self._admit('get_status', client_id)
+        started = self._start_call('get_status')
+        try:
+            self._modem_proxy.refresh_client(client_id, get_client_address())
+            return self._modem_proxy.get_status()
+        finally:
+            self._end_call('get_status', started)
+
+    def get_extended_status(self, client_id):
+        """Returns get_status() along with the progress of dialling.
+
+        The struct returned has these members:
+
+        current_clients    -- As for get_status()
+        is_connected       -- As for get_status()
+        seconds_connected  -- As for get_status()
+        state              -- "idle", "dialling", "connected" or
+                              "hanging up"
+        dial_attempt       -- The current dial attempt (0 if not
+                              dialling)
+        max_dial_attempts  -- Attempts made before giving up
+        redial_in          -- Seconds until the modem is dialled
+                              again, or -1 if no redial is waiting
+
+        """
+        self._admit('get_extended_status', client_id)
+        started = self._start_call('get_extended_status')
+        try:
+            proxy = self._modem_proxy
+            proxy.refresh_client(client_id, get_client_address())
+            clients, is_connected, seconds = proxy.get_status()
+            attempt, redial_in = proxy.get_dial_status()
+            if redial_in is None:
+                redial_in = -1
+            return {'current_clients': clients,
+                    'is_connected': is_connected,
+                    'seconds_connected': seconds,
+                    'state': proxy.state,
+                    'dial_attempt': attempt,
+                    'max_dial_attempts': proxy.max_dial_attempts,
+                    'redial_in': int(round(redial_in))}
+        finally:
+            self._end_call('get_extended_status', started)
+
+    def get_status_many(self, client_ids):
+        """Returns get_status() for each of a list of clients.
+
+        Lets a proxy or dashboard that fronts several users keep them
+        all alive with a single request. The link is only checked once
+        for the whole batch.
+
+        """
+        self._admit_many('get_status_many', client_ids)
+        started = self._start_call('get_status_many')
+        try:
+            self._modem_proxy.refresh_clients(client_ids,
+                                              get_client_address())
+            return [self._modem_proxy.get_status()] * len(client_ids)
+        finally:
+            self._end_call('get_status_many', started)
+
+    def get_usage(self, period, count=12):
+        """Returns the time spent on line per day or month.
+
+        period should be "day" or "month". A list of up to count
+        structs is returned, most recent first, each with these
+        members:
+
+        period    -- The day (YYYY-MM-DD) or month (YYYY-MM)
+        sessions  -- Number of connections started
+        seconds   -- Number of seconds connected
+        rx_bytes  -- Bytes received
+        tx_bytes  -- Bytes sent
+
+        """
+        if self._usage is None:
+            raise xmlrpclib.Fault(2, 'usage accounting is not enabled')
+        try:
+            return self._usage.get_usage(period, count)
+        except ValueError, e:
+            raise xmlrpclib.Fault(3, str(e))
+
+    def wait_for_status_change(self, client_id, last_version, timeout):
+        """Waits for the status to change, then returns it.
+
+        Clients can call this in a loop instead of polling
+        get_status(), passing the version returned by the previous
+        call (or 0 the first time). The values returned are:
+
+        version            -- Pass this to the next call
+        current_clients    -- As for get_status()
+        is_connected       -- As for get_status()
+        seconds_connected  -- As for get_status()
+
+        The call returns early when the number of clients or the
+        connection status changes, and otherwise after timeout
+        seconds (limited to max_wait). Waiting keeps the client
+        alive, just like calling get_status().
+
+        Servers that can't wait without holding up other clients
+        (those with max_wait set to 0, such as the single and async
+        servers) return fault 5; clients should then poll get_status()
+        instead.
+
+        """
+        self._admit('wait_for_status_change', client_id)
+        if self.max_wait <= 0:
+            raise xmlrpclib.Fault(5, 'waiting is not supported, '
+                                  'poll get_status() instead')
+        address = get_client_address()
+        self._modem_proxy.refresh_client(client_id, address)
+        timeout = max(0, min(timeout, self.max_wait))
+        status = self._modem_proxy.wait_for_status_change(last_version,
+                                                          timeout)
+        self._modem_proxy.refresh_client(client_id, address)
+        return status
+    
+
+class Wakeup(object):
+
+    """An Event whose waiters can also be woken without setting it.
+
+    wait() returns once set() has been called, as with an Event, or
+    when ring() is called. A ring while nobody is waiting cuts the
+    next wait() short, so it isn't lost.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._is_set = False
+        self._rung = False
+
+    def set(self):
+        self._cond.acquire()
+        try:
+            self._is_set = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def isSet(self):
+        return self._is_set
+
+    def ring(self):
+        self._cond.acquire()
+        try:
+            self._rung = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def wait(self, timeout):
+        self._cond.acquire()
+        try:
+            if not (self._is_set or self._rung):
+                self._cond.wait(timeout)
+            self._rung = False
+        finally:
+            self._cond.release()
+
+
+class AutoDisconnectThread(threading.Thread):
+
+    """Forgets clients that have stopped polling.
+
+    The thread sleeps until the next client is due to time out, or a
+    delayed hangup or dialling deadline falls due; the proxy wakes it
+    when one of those is set. When there are no clients, or commands
+    are running that need reaping, it checks again every
+    INTER_CHECK_PERIOD seconds.
+
+    """
+
+    INTER_CHECK_PERIOD = 5  # seconds
+
+    def __init__(self, modem_proxy):
+        threading.Thread.__init__(self)
+        self._modem_proxy = modem_proxy
+        self.finished = Wakeup()
+        modem_proxy.wakeup = self.finished.ring
+        self.setDaemon(True)
+        self.setName('AutoDisconnect')
+
+    def run(self):
+        proxy = self._modem_proxy
+        while not self.finished.isSet():
+            proxy.remove_old_clients()
+            proxy.hang_up_if_due()
+            proxy.check_dialling()
+            proxy.reap_commands()
+            delay = proxy.next_expiry()
+            if delay is None:
+                delay = self.INTER_CHECK_PERIOD
+            elif proxy.count_running_commands():
+                delay = min(delay, self.INTER_CHECK_PERIOD)
+            self.finished.wait(delay)
+
+
+class LinkMonitorThread(threading.Thread):
+
+    """Probes the link at a fixed rate on behalf of all clients.
+
+    Once the monitor is running the proxy's get_status() returns the
+    snapshot published by the monitor, so the time taken to check the
+    link no longer affects how long a client waits for its status.
+
+    """
+
+    def __init__(self, modem_proxy, period):
+        threading.Thread.__init__(self)
+        self._modem_proxy = modem_proxy
+        self.period = period
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('LinkMonitor')
+
+    def run(self):
+        proxy = self._modem_proxy
+        proxy.update_status()
+        proxy.is_monitored = True
+        try:
+            while not self.finished.isSet():
+                self.finished.wait(self.period)
+                proxy.update_status()
+        finally:
+            proxy.is_monitored = False
+
+
+class IdleHangupThread(threading.Thread):
+
+    """Hangs up when nobody is using the connection.
+
+    Clients that leave their GUI running keep polling long after they
+    have stopped using the Internet. While the line is up this thread
+    samples the interface's byte counters every SAMPLE_PERIOD seconds,
+    and hangs up once the throughput has stayed below threshold bytes
+    per second for idle_time seconds.
+
+    """
+
+    SAMPLE_PERIOD = 5  # seconds
+
+    def __init__(self, modem_proxy, monitor, threshold, idle_time):
+        threading.Thread.__init__(self)
+        self._modem_proxy = modem_proxy
+        self._monitor = monitor
+        self.threshold = threshold
+        self.idle_time = idle_time
+        self._quiet_since = None
+        self.finished = threading.Event()
+        self.setDaemon(True)
+        self.setName('IdleHangup')
+
+    def check(self):
+        proxy = self._modem_proxy
+        if proxy.state != proxy.CONNECTED:
+            self._monitor.reset()
+            self._quiet_since = None
+            return
+        self._monitor.sample()
+        rate = self._monitor.rate()
+        if rate is None or rate >= self.threshold:
+            self._quiet_since = None
+        elif self._quiet_since is None:
+            self._quiet_since = monotonic()
+        elif monotonic() - self._quiet_since >= self.idle_time:
+            log.info('Hanging up, less than %s bytes/s for %d seconds' %
+                     (self.threshold, self.idle_time))
+            proxy.disconnect()
+            self._monitor.reset()
+            self._quiet_since = None
+
+    def run(self):
+        while not self.finished.isSet():
+            self.finished.wait(self.SAMPLE_PERIOD)
+            self.check()
+
+
+class FastDispatchMixin:
+
+    """Short cuts XML-RPC marshalling for the core API methods.
+
+    Calls to connect(), disconnect() and get_status() are recognised
+    with a regular expression rather than the generic unmarshaller,
+    and their responses are built from precompiled templates. Anything
+    that doesn't fit the expected pattern (other methods, escaped or
+    non-ASCII characters, unexpected return values) goes through the
+    normal dispatcher, which decodes client ids in the same way.
+
+    """
+
+    FAST_CALL = re.compile(
+        r'\s*(?:<\?xml[^>]*\?>)?\s*<methodCall>\s*'
+        r'<methodName>(connect|disconnect|get_status)</methodName>\s*'
+        r'<params>\s*<param>\s*'
+        r'<value>(?:<string>([^<&\x80-\xff]*)</string>|'
+        r'([^<&\x80-\xff]*))</value>\s*'
+        r'</param>\s*'
+        r'(?:<param>\s*<value>\s*<boolean>([01])</boolean>\s*</value>\s*'
+        r'</param>\s*)?'
+        r'</params>\s*</methodCall>\s*$')
+
+    RESPONSE = ("<?xml version='1.0'?>\n"
+                "<methodResponse>\n<params>\n<param>\n"
+                "%s\n"
+                "</param>\n</params>\n</methodResponse>\n")
+    STATUS_RESPONSE = RESPONSE % ('<value><array><data>\n'
+                                  '<value><int>%d</int></value>\n'
+                                  '<value><boolean>%d</boolean></value>\n'
+                                  '<value><int>%d</int></value>\n'
+                                  '</data></array></value>')
+    TRUE_RESPONSE = RESPONSE % '<value><boolean>1</boolean></value>'
+    RATE_LIMITED_RESPONSE = xmlrpclib.dumps(RateLimited())
+
+    MAXINT = 2 ** 31 - 1
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, *args):
+        match = self.FAST_CALL.match(data)
+        if match is None or dispatch_method is not None:
+            return SimpleXMLRPCServer.SimpleXMLRPCDispatcher._marshaled_dispatch(
+                self, data, dispatch_method, *args)
+        method, client_id, untyped_id, all = match.groups()
+        if client_id is None:
+            client_id = untyped_id
+        if all is None:
+            params = (client_id,)
+        else:
+            params = (client_id, all == '1')
+        try:
+            result = self._dispatch(method, params)
+        except RateLimited:
+            return self.RATE_LIMITED_RESPONSE
+        except xmlrpclib.Fault, fault:
+            return xmlrpclib.dumps(fault, allow_none=self.allow_none,
+                                   encoding=self.encoding)
+        except:
+            exc_type, exc_value = sys.exc_info()[:2]
+            return xmlrpclib.dumps(
+                xmlrpclib.Fault(1, '%s:%s' % (exc_type, exc_value)),
+                allow_none=self.allow_none, encoding=self.encoding)
+        return self._marshal_result(result)
+
+    def _marshal_result(self, result):
+        if result is True:
+            return self.TRUE_RESPONSE
+        try:
+            clients, is_connected, seconds = result
+        except (TypeError, ValueError):
+            pass
+        else:
+            if (type(clients) is int and type(seconds) is int and
+                type(is_connected) is bool and
+                0 <= clients <= self.MAXINT and 0 <= seconds <= self.MAXINT):
+                return self.STATUS_RESPONSE % (clients, is_connected, seconds)
+        return xmlrpclib.dumps((result,), methodresponse=1,
+                               allow_none=self.allow_none,
+                               encoding=self.encoding)
+
+
+class RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    """Handles XML-RPC requests, keeping connections open if allowed.
+
+    When the server's keepalive_timeout is set the handler speaks
+    HTTP/1.1, so clients can send further requests over the same
+    connection. Connections are closed after keepalive_timeout seconds
+    without a request, or after the current request if the server
+    already has max_keepalive connections open.
+
+    """
+
+    def setup(self):
+        if self.server.keepalive_timeout > 0:
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = self.server.keepalive_timeout
+        self.server.connection_opened()
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.setup(self)
+
+    def finish(self):
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.finish(self)
+        finally:
+            self.server.connection_closed()
+
+    def end_headers(self):
+        if (self.protocol_version == 'HTTP/1.1' and
+            not self.server.may_keep_alive()):
+            self.send_header('Connection', 'close')
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.end_headers(self)
+
+    def do_POST(self):
+        request_context.address = self.client_address[0]
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+        finally:
+            request_context.address = None
+
+
+class ReusableSimpleXMLRPCServer(FastDispatchMixin,
+                                 SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+    allow_reuse_address = True
+    keepalive_timeout = 0  # seconds, 0 closes after every request
+    max_keepalive = 0
+
+    def __init__(self, addr, requestHandler=RequestHandler, sock=None,
+                 **kwargs):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+            self, addr, requestHandler, bind_and_activate=sock is None,
+            **kwargs)
+        if sock is not None:
+            # Already bound and listening (see listening_socket()).
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+        self._connections = 0
+        self._connections_lock = threading.Lock()
+
+    def connection_opened(self):
+        self._connections_lock.acquire()
+        try:
+            self._connections += 1
+        finally:
+            self._connections_lock.release()
+
+    def connection_closed(self):
+        self._connections_lock.acquire()
+        try:
+            self._connections -= 1
+        finally:
+            self._connections_lock.release()
+
+    def count_connections(self):
+        return self._connections
+
+    def may_keep_alive(self):
+        return self._connections <= self.max_keepalive
+
+
+class ThreadingXMLRPCServer(SocketServer.ThreadingMixIn,
+                            ReusableSimpleXMLRPCServer):
+
+    """Handles each request in a new thread."""
+
+    daemon_threads = True
+
+
+class PooledXMLRPCServer(ReusableSimpleXMLRPCServer):
+
+    """Handles requests in a fixed size pool of worker threads.
+
+    Accepted connections are queued for the workers; once the queue is
+    full the server stops accepting until a worker is free, so the
+    number of threads and pending requests stay bounded.
+
+    """
+
+    POOL_SIZE = 4
+
+    def __init__(self, addr, pool_size=POOL_SIZE, **kwargs):
+        ReusableSimpleXMLRPCServer.__init__(self, addr, **kwargs)
+        self.pool_size = pool_size
+        self._requests = Queue.Queue(pool_size * 2)
+        for i in range(pool_size):
+            worker = threading.Thread(target=self._work,
+                                      name='Worker-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+
+class XMLRPCChannel(asynchat.async_chat):
+
+    """Reads HTTP requests from a client and sends the responses.
+
+    The connection is kept open for further requests if the client
+    asks for it and the server's keep-alive limits allow it.
+
+    """
+
+    MAX_HEADER_SIZE = 8192
+
+    def __init__(self, server, sock, map):
+        asynchat.async_chat.__init__(self, sock, map)
+        self._server = server
+        self._buffer = []
+        self._buffered = 0
+        self._keep_alive = False
+        self.last_active = monotonic()
+        self._start_request()
+
+    def _start_request(self):
+        self._request_line = None
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.last_active = monotonic()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if (self._request_line is None and
+            self._buffered > self.MAX_HEADER_SIZE):
+            self._respond(413, 'Request Entity Too Large')
+
+    def found_terminator(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._request_line is None:
+            self._read_headers(data)
+        else:
+            self._dispatch(data)
+
+    def _read_headers(self, data):
+        lines = data.split('\r\n')
+        self._request_line = lines[0]
+        words = lines[0].split()
+        if len(words) != 3 or words[0] != 'POST':
+            self._respond(501, 'Not Implemented')
+            return
+        if words[1] not in ('/', '/RPC2'):
+            self._respond(404, 'Not Found')
+            return
+        length = None
+        connection = ''
+        for line in lines[1:]:
+            fields = line.split(':', 1)
+            if len(fields) != 2:
+                continue
+            name = fields[0].strip().lower()
+            if name == 'content-length':
+                try:
+                    length = int(fields[1])
+                except ValueError:
+                    pass
+            elif name == 'connection':
+                connection = fields[1].strip().lower()
+        if words[2] == 'HTTP/1.1':
+            wants_keep_alive = connection != 'close'
+        else:
+            wants_keep_alive = connection == 'keep-alive'
+        self._keep_alive = wants_keep_alive and self._server.may_keep_alive()
+        if length is None or length < 0:
+            self._respond(411, 'Length Required')
+        elif length == 0:
+            self._dispatch('')
+        else:
+            self.set_terminator(length)
+
+    def _dispatch(self, body):
+        request_context.address = self.addr[0]
+        try:
+            try:
+                response = self._server._marshaled_dispatch(body)
+            except Exception:
+                self._respond(500, 'Internal Server Error')
+                return
+        finally:
+            request_context.address = None
+        self._respond(200, 'OK', response, self._keep_alive)
+
+    def _respond(self, code, message, body='', keep_alive=False):
+        self.set_terminator(None)
+        if keep_alive:
+            headers = ['HTTP/1.1 %d %s' % (code, message)]
+        else:
+            headers = ['HTTP/1.0 %d %s' % (code, message),
+                       'Connection: close']
+        headers.extend(['Content-Type: text/xml',
+                        'Content-Length: %d' % len(body),
+                        '', ''])
+        self.push('\r\n'.join(headers) + body)
+        self.last_active = monotonic()
+        if keep_alive:
+            self._start_request()
+        else:
+            self.close_when_done()
+
+    def is_idle(self, timeout):
+        return (self._request_line is None and not self.writable() and
+                monotonic() - self.last_active > timeout)
+
+    def handle_error(self):
+        self.close()
+
+
+class AsyncXMLRPCServer(asyncore.dispatcher, FastDispatchMixin,
+                        SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
+
+    """Serves every client from a single event loop.
+
+    There is no thread per request or per connection, so one process
+    can hold open connections to a great many clients. The API methods
+    are called from the event loop, so the link should be watched by a
+    LinkMonitorThread rather than probed by get_status().
+
+    """
+
+    keepalive_timeout = 0
+    max_keepalive = 0
+
+    def __init__(self, addr, logRequests=False, sock=None):
+        SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(self, False, None)
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        if sock is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind(addr)
+            self.listen(socket.SOMAXCONN)
+        else:
+            sock.setblocking(0)
+            self.set_socket(sock)
+            self.accepting = True
+        self.server_address = self.socket.getsockname()
+        self._is_shut_down = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            XMLRPCChannel(self, pair[0], self._map)
+
+    def handle_error(self):
+        # Accepting can fail if a client gives up on us straight away;
+        # that shouldn't stop the server.
+        pass
+
+    def count_connections(self):
+        return len(self._map) - 1
+
+    def may_keep_alive(self):
+        return (self.keepalive_timeout > 0 and
+                self.count_connections() <= self.max_keepalive)
+
+    def close_idle_connections(self):
+        for channel in self._map.values():
+            if (isinstance(channel, XMLRPCChannel) and
+                channel.is_idle(self.keepalive_timeout)):
+                channel.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down = False
+        last_sweep = monotonic()
+        while not self._is_shut_down:
+            asyncore.loop(poll_interval, True, self._map, 1)
+            if self.keepalive_timeout > 0:
+                now = monotonic()
+                if now - last_sweep >= min(1, self.keepalive_timeout):
+                    self.close_idle_connections()
+                    last_sweep = now
+
+    def shutdown(self):
+        self._is_shut_down = True
+
+    def server_close(self):
+        for channel in self._map.values():
+            channel.close()
+
+
+class DatagramHandler(SocketServer.BaseRequestHandler):
+
+    """Serves the LANdialler API over a compact UDP protocol.
+
+    Each request is a single datagram made up of a fixed header
+    followed by the client id:
+
+      magic    2 bytes  "LD"
+      version  1 byte   1
+      opcode   1 byte   1 = connect, 2 = disconnect, 3 = get_status
+      flags    1 byte   bit 0 set to disconnect all users
+      client   rest of the datagram
+
+    The reply has the same magic, version and opcode, followed by:
+
+      result             1 byte   0 = ok, 1 = refused, 2 = bad request,
+                                  3 = too many requests
+      current_clients    4 bytes  unsigned, network byte order
+      is_connected       1 byte   0 or 1
+      seconds_connected  4 bytes  unsigned, network byte order
+
+    The last three fields are only filled in for get_status.
+    Datagrams that don't start with the magic number are ignored.
+
+    """
+
+    MAGIC = 'LD'
+    VERSION = 1
+    CONNECT, DISCONNECT, GET_STATUS = 1, 2, 3
+    OK, REFUSED, BAD_REQUEST, BUSY = 0, 1, 2, 3
+    DISCONNECT_ALL = 0x01
+
+    REQUEST = struct.Struct('!2sBBB')
+    RESPONSE = struct.Struct('!2sBBBIBI')
+
+    def handle(self):
+        data, sock = self.request
+        request_context.address = self.client_address[0]
+        try:
+            response = self.respond(data)
+        finally:
+            request_context.address = None
+        if response is not None:
+            sock.sendto(response, self.client_address)
+
+    def respond(self, data):
+        header_size = self.REQUEST.size
+        if len(data) < header_size or data[:2] != self.MAGIC:
+            return None
+        magic, version, opcode, flags = self.REQUEST.unpack(data[:header_size])
+        client_id = data[header_size:]
+        api = self.server.api
+        result = self.OK
+        clients, is_connected, seconds = 0, False, 0
+        try:
+            if version != self.VERSION or not client_id:
+                result = self.BAD_REQUEST
+            elif opcode == self.CONNECT:
+                try:
+                    api.connect(client_id)
+                except RateLimited:
+                    raise
+                except xmlrpclib.Fault:
+                    result = self.REFUSED
+            elif opcode == self.DISCONNECT:
+                api.disconnect(client_id, bool(flags & self.DISCONNECT_ALL))
+            elif opcode == self.GET_STATUS:
+                clients, is_connected, seconds = api.get_status(client_id)
+            else:
+                result = self.BAD_REQUEST
+        except RateLimited:
+            result = self.BUSY
+        return self.RESPONSE.pack(self.MAGIC, self.VERSION, opcode, result,
+                                  clients, is_connected, seconds)
+
+
+class DatagramServer(SocketServer.UDPServer):
+
+    """Answers DatagramHandler requests with the given API object."""
+
+    allow_reuse_address = True
+
+    def __init__(self, addr, api):
+        SocketServer.UDPServer.__init__(self, addr, DatagramHandler)
+        self.api = api
+
+
+SERVER_MODES = {
+    'single': ReusableSimpleXMLRPCServer,
+    'threading': ThreadingXMLRPCServer,
+    'pool': PooledXMLRPCServer,
+    'async': AsyncXMLRPCServer,
+}
+
+SD_LISTEN_FDS_START = 3
+SO_DOMAIN = getattr(socket, 'SO_DOMAIN', 39)  # Linux
+
+
+def listening_socket(addr):
+    """Return a TCP socket that is bound to addr and listening.
+
+    Connections made before the server is ready wait in the listen
+    queue rather than being refused.
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def get_activated_socket(fd=SD_LISTEN_FDS_START):
+    """Return the listening socket passed in by systemd, or None.
+
+    With socket activation the service manager holds the port open
+    between restarts and passes it to us as fd 3, setting LISTEN_PID
+    and LISTEN_FDS (see sd_listen_fds(3)). The variables are removed
+    so that the commands we run don't think the socket is theirs.
+
+    """
+    try:
+        pid = int(os.environ.get('LISTEN_PID', 0))
+        count = int(os.environ.get('LISTEN_FDS', 0))
+    except ValueError:
+        return None
+    if pid != os.getpid() or count < 1:
+        return None
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    family = sock.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+    if family != socket.AF_INET:
+        duplicate, sock = sock, socket.fromfd(fd, family, socket.SOCK_STREAM)
+        duplicate.close()
+    os.close(fd)  # fromfd() made a copy
+    return sock
+
+ 
+class App(object):
+
+    STATUS_CACHE_TTL = 2  # seconds
+    MONITOR_PERIOD = 2
+    KEEPALIVE_TIMEOUT = 15
+    MAX_KEEPALIVE = 64
+    IDLE_TIME = 600
+    RATE_BURST = 10
+
+    # Checked by reload() before any of them are applied.
+    RELOADED_OPTIONS = [
+        ('status_cache_ttl', float), ('max_clients', int),
+        ('monitor_period', float), ('idle_threshold', float),
+        ('idle_time', float), ('hangup_delay', float),
+        ('dial_timeout', float), ('max_dial_attempts', int),
+        ('redial_delay', float), ('max_redial_delay', float),
+        ('max_wait', float), ('client_rate_limit', float),
+        ('client_rate_burst', int), ('address_rate_limit', float),
+        ('address_rate_burst', int), ('max_keepalive', int),
+        ('keepalive_timeout', float), ('log_rate_limit', int),
+        ('command_timeout', float), ('clients_per_link', int)]
+
+    def __init__(self):
+        self._become_daemon = True
+        self._config = self._load_config_file()
+        self._mode = get_option(self._config, 'general', 'server_mode',
+                                'single')
+        self._server = None
+        self._port = None
+        self._api = None
+        self._monitor = None
+        self._idle_hangup = None
+        self._reload_requested = threading.Event()
+        self._modem = modem = self._make_modem()
+        status_ttl = get_option(self._config, 'general', 'status_cache_ttl',
+                                self.STATUS_CACHE_TTL, float)
+        max_clients = get_option(self._config, 'general', 'max_clients',
+                                 ClientRegistry.MAX_CLIENTS, int)
+        self._modem_proxy = ModemProxy(modem, status_ttl, max_clients)
+        self._configure_dialling()
+        if isinstance(modem, ModemPool):
+            self._modem_proxy.links = modem
+        self._journal = None
+        self._usage = None
+
+    def _open_journal(self):
+        # Done before daemonise(), while errors can still be reported.
+        state_file = get_option(self._config, 'general', 'state_file', '')
+        if not state_file:
+            return
+        try:
+            journal = StateJournal(state_file)
+            self._modem_proxy.restore(journal.load())
+            self._modem_proxy.save(journal)
+        except (IOError, OSError), e:
+            print 'Terminating - error writing state file: %s' % e
+            sys.exit()
+        self._journal = journal
+        self._modem_proxy.journal = journal
+
+    def _open_usage_db(self):
+        # Done after daemonise() so that no sqlite connection is
+        # carried across the fork.
+        usage_db = get_option(self._config, 'general', 'usage_db', '')
+        if usage_db:
+            self._usage = UsageDatabase(usage_db)
+            accountant = UsageAccountant(self._usage,
+                                         get_interface(self._config))
+            if self._modem_proxy.state == ModemProxy.CONNECTED:
+                # A session carried over from before a restart.
+                accountant.session_started(self._modem.timer.start_time,
+                                           self._modem_proxy.client_ids())
+            self._modem_proxy.accounting = accountant
+
+    def _make_modem(self):
+        timeout = get_option(self._config, 'general', 'command_timeout',
+                             CommandRunner.TIMEOUT, float)
+        links = []
+        for section in self._config.sections():
+            if section.startswith('link:'):
+                modem = Modem(self._config, runner=CommandRunner(timeout),
+                              section=section)
+                links.append((section[len('link:'):], modem))
+        if not links:
+            return Modem(self._config, runner=CommandRunner(timeout))
+        clients_per_link = get_option(self._config, 'general',
+                                      'clients_per_link',
+                                      ModemPool.CLIENTS_PER_LINK, int)
+        return ModemPool(links, clients_per_link)
+
+    def _read_config_file(self):
+        config = ConfigParser.ConfigParser()
+        config.read(['/usr/local/etc/landiallerd.conf',
+                     '/etc/landiallerd.conf',
+                     'landiallerd.conf'])
+        return config
+
+    def _load_config_file(self):
+        try:
+            return self._read_config_file()
+        except Exception, e:
+            print 'Terminating - error reading config file: %s' % e
+            sys.exit()
+
+    def make_server(self, addr, sock=None):
+        try:
+            server_class = SERVER_MODES[self._mode]
+        except KeyError:
+            print 'Terminating - unknown server_mode: %s' % self._mode
+            sys.exit()
+        if server_class is PooledXMLRPCServer:
+            pool_size = get_option(self._config, 'general', 'pool_size',
+                                   PooledXMLRPCServer.POOL_SIZE, int)
+            server = server_class(addr, pool_size, logRequests=False,
+                                  sock=sock)
+        else:
+            server = server_class(addr, logRequests=False, sock=sock)
+        self._configure_keepalive(server)
+        return server
+
+    def _configure_keepalive(self, server):
+        max_keepalive = get_option(self._config, 'general', 'max_keepalive',
+                                   self.MAX_KEEPALIVE, int)
+        if isinstance(server, PooledXMLRPCServer):
+            # Each open connection ties up a worker, so leave one free.
+            max_keepalive = min(max_keepalive, server.pool_size - 1)
+        if self._mode != 'single' and max_keepalive > 0:
+            server.keepalive_timeout = get_option(
+                self._config, 'general', 'keepalive_timeout',
+                self.KEEPALIVE_TIMEOUT, float)
+            server.max_keepalive = max_keepalive
+        else:
+            server.keepalive_timeout = 0
+            server.max_keepalive = 0
+
+    def _get_max_wait(self):
+        if self._mode in ('single', 'async'):
+            return 0
+        return get_option(self._config, 'general', 'max_wait',
+                          API.MAX_WAIT, float)
+
+    def _configure_monitor(self):
+        period = get_option(self._config, 'general', 'monitor_period',
+                            self.MONITOR_PERIOD, float)
+        if period <= 0 and self._mode == 'async':
+            log.warn('Monitoring link every %s seconds for async server' %
+                     self.MONITOR_PERIOD)
+            period = self.MONITOR_PERIOD
+        if period <= 0:
+            if self._monitor is not None:
+                self._monitor.finished.set()
+                self._monitor = None
+        elif self._monitor is None:
+            self._monitor = LinkMonitorThread(self._modem_proxy, period)
+            self._monitor.start()
+        else:
+            self._monitor.period = period
+
+    def _configure_idle_hangup(self):
+        threshold = get_option(self._config, 'general', 'idle_threshold',
+                               0, float)
+        idle_time = get_option(self._config, 'general', 'idle_time',
+                               self.IDLE_TIME, float)
+        if self._idle_hangup is not None:
+            self._idle_hangup.threshold = threshold
+            self._idle_hangup.idle_time = idle_time
+        elif threshold > 0:
+            monitor = TrafficMonitor(get_interface(self._config),
+                                     min(idle_time, TrafficMonitor.WINDOW))
+            self._idle_hangup = IdleHangupThread(self._modem_proxy, monitor,
+                                                 threshold, idle_time)
+            self._idle_hangup.start()
+
+    def _configure_dialling(self):
+        proxy = self._modem_proxy
+        for option, default, convert in [
+            ('hangup_delay', 0, float),
+            ('dial_timeout', ModemProxy.DIAL_TIMEOUT, float),
+            ('max_dial_attempts', ModemProxy.MAX_DIAL_ATTEMPTS, int),
+            ('redial_delay', ModemProxy.REDIAL_DELAY, float),
+            ('max_redial_delay', ModemProxy.MAX_REDIAL_DELAY, float)]:
+            setattr(proxy, option, get_option(self._config, 'general',
+                                              option, default, convert))
+
+    def _configure_rate_limits(self):
+        for kind in ('client', 'address'):
+            rate = get_option(self._config, 'general', '%s_rate_limit' % kind,
+                              0, float)
+            burst = get_option(self._config, 'general', '%s_rate_burst' % kind,
+                               self.RATE_BURST, int)
+            limiter = None
+            if rate > 0:
+                limiter = RateLimiter(rate, burst)
+            setattr(self._api, '%s_limiter' % kind, limiter)
+
+    def _listen(self, port, sock=None):
+        server = self.make_server(('', port), sock)
+        server.register_instance(self._api)
+        server.register_multicall_functions()
+        return server
+
+    def reload(self):
+        """Apply changes to the config file without dropping the link.
+
+        The commands, timeouts, limits and port all take effect at
+        once; clients with open connections to the old port are served
+        until they disconnect. The server_mode, pool_size, udp_port,
+        metrics_port, state_file and usage_db options are only read
+        at startup.
+
+        """
+        log.info('Reloading config file')
+        try:
+            config = self._read_config_file()
+            config.getint('general', 'port')
+            for option, convert in self.RELOADED_OPTIONS:
+                get_option(config, 'general', option, None, convert)
+            self._modem.configure(config)
+        except Exception, e:
+            log.error('Not reloading config file: %s' % e)
+            return
+        self._config = config
+        self.configure_logging()
+        status_ttl = get_option(config, 'general', 'status_cache_ttl',
+                                self.STATUS_CACHE_TTL, float)
+        max_clients = get_option(config, 'general', 'max_clients',
+                                 ClientRegistry.MAX_CLIENTS, int)
+        self._modem_proxy.configure(status_ttl, max_clients)
+        self._configure_monitor()
+        self._configure_idle_hangup()
+        self._configure_dialling()
+        if self._server is None:
+            return
+        self._api.max_wait = self._get_max_wait()
+        self._configure_rate_limits()
+        port = config.getint('general', 'port')
+        if port == self._port:
+            self._configure_keepalive(self._server)
+            return
+        try:
+            server = self._listen(port)
+        except socket.error, e:
+            log.error('Not listening on port %d: %s' % (port, e))
+            return
+        log.info('Listening on port %d' % port)
+        self._port = port
+        previous, self._server = self._server, server
+        previous.shutdown()
+
+    def _handle_sighup(self, signum, frame):
+        # Reloading takes locks that the interrupted thread may hold,
+        # so the work is handed to another thread.
+        self._reload_requested.set()
+
+    def _reload_when_requested(self):
+        while True:
+            self._reload_requested.wait()
+            self._reload_requested.clear()
+            try:
+                self.reload()
+            except Exception, e:
+                log.error('Error reloading config file: %s' % e)
+
+    def check_platform(self):
+        if os.name != "posix":
+            print "Sorry, only POSIX compliant systems are supported."
+            sys.exit()
+
+    def daemonise(self):
+        """Become a daemon process (POSIX only)."""
+        if not self._become_daemon:
+            return
+
+        # See "Python Standard Library", pg. 29, O'Reilly, for more
+        # info on the following.
+        log.flush()
+        pid = os.fork()
+        if pid:  # we're the parent if pid is set
+            os._exit(0)
+
+        os.setpgrp()
+        os.umask(0)
+
+        class DevNull:
+
+            def write(self, message):
+                pass
+            
+        sys.stdin.close()
+        sys.stdout = DevNull()
+        sys.stderr = DevNull()
+
+    def getopt(self):
+        opts, args = getopt.getopt(sys.argv[1:], "dfhl:s")
+
+        log_file = None
+        use_syslog = False
+        for o, v in opts:
+            if o == "-f":
+                self._become_daemon = False
+            elif o == "-l":
+                log_file = v
+            elif o == "-s":
+                use_syslog = True
+
+        if log_file:
+            log.set_backend(StreamBackend(open(log_file, 'a')))
+        elif self._become_daemon or use_syslog:
+            log.set_backend(SyslogBackend())
+        else:
+            log.set_backend(StreamBackend(sys.stderr))
+
+    def configure_logging(self):
+        log.rate_limit = get_option(self._config, 'general',
+                                    'log_rate_limit', 0, int)
+
+    def bind(self):
+        """Return the listening socket for the XML-RPC server.
+
+        The socket is bound before anything slow happens, so clients
+        that connect while we start up are queued rather than refused.
+        Under systemd socket activation the socket is passed in and
+        stays open across restarts.
+
+        """
+        self._port = self._config.getint('general', 'port')
+        sock = get_activated_socket()
+        if sock is not None:
+            log.info('Using listening socket from service manager')
+            return sock
+        try:
+            return listening_socket(('', self._port))
+        except socket.error, e:
+            print 'Terminating - error listening on port %d: %s' % (
+                self._port, e)
+            sys.exit()
+
+    def main(self):
+        started = monotonic()
+        self.check_platform()
+        self.configure_logging()
+        try:
+            self.getopt()
+        except getopt.GetoptError, e:
+            sys.stderr.write("%s\n" % e)
+        sock = self.bind()
+        log.info('Starting')
+        self._open_journal()
+        self.daemonise()
+        self._open_usage_db()
+
+        thread = AutoDisconnectThread(self._modem_proxy)
+        thread.start()
+        if self._journal is not None:
+            JournalThread(self._modem_proxy, self._journal).start()
+        self._configure_monitor()
+        self._configure_idle_hangup()
+
+        api = self._api = API(self._modem_proxy, self._get_max_wait(),
+                              self._usage)
+        self._configure_rate_limits()
+        self._server = self._listen(self._port, sock)
+
+        udp_port = get_option(self._config, 'general', 'udp_port', 0, int)
+        if udp_port:
+            udp_server = DatagramServer(('', udp_port), api)
+            thread = threading.Thread(target=udp_server.serve_forever,
+                                      name='DatagramServer')
+            thread.setDaemon(True)
+            thread.start()
+
+        metrics.set_gauge('landialler_clients', self._modem_proxy.count_clients)
+        metrics_port = get_option(self._config, 'general', 'metrics_port',
+                                  0, int)
+        if metrics_port:
+            metrics_server = MetricsServer(('', metrics_port))
+            thread = threading.Thread(target=metrics_server.serve_forever,
+                                      name='MetricsServer')
+            thread.setDaemon(True)
+            thread.start()
+        thread = threading.Thread(target=self._reload_when_requested,
+                                  name='Reload')
+        thread.setDaemon(True)
+        thread.start()
+        signal.signal(signal.SIGHUP, self._handle_sighup)
+        log.info('Ready on port %d after %.0f ms' %
+                 (self._server.server_address[1],
+                  (monotonic() - started) * 1000))
         try:
-            server.serve_forever()
+            while True:
+                server = self._server
+                server.serve_forever()
+                if server is self._server:
+                    break
+                server.server_close()  # replaced after a change of port
         except KeyboardInterrupt:
             print "Caught Ctrl-C, shutting down."
             log.info('Exit')
+            if self._modem_proxy.accounting is not None:
+                self._modem_proxy.accounting.flush()
+            log.flush()
+            if self._journal is not None:
+                self._journal.sync()
 
     
 if __name__ == "__main__":
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# landiallerd_bench.py - load generator for the LANdialler daemon
+#
+# Copyright (C) 2001-2004 Graham Ashton
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""measures how landiallerd.py copes with many clients
+
+Starts landiallerd.py in the foreground (-f) with a config file whose
+connect, disconnect and is_connected commands do nothing, then drives
+a number of simulated clients against it. Each client connects, polls
+get_status() at a fixed interval (with a little jitter) and now and
+again disconnects and connects again, much as the GUI client does.
+
+At the end the time the daemon took to start listening, the requests
+per second, the 50th and 99th percentile latency and the daemon's CPU
+time per request are printed. The random
+number generator is seeded so that runs with the same options are
+comparable.
+
+usage: landiallerd_bench.py [options]
+
+  -c clients    number of simulated clients (default 50)
+  -d seconds    length of the measured run (default 10)
+  -i seconds    interval between polls per client (default 0.1)
+  -m mode       server_mode for the daemon (default single)
+  -o key=value  extra [general] option for the daemon (repeatable)
+  -s seed       random number seed (default 1)
+  -w seconds    warm up time excluded from the results (default 2)
+
+"""
+
+
+import getopt
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'landiallerd.py')
+
+CONFIG = """[commands]
+connect: true
+disconnect: true
+is_connected: true
+
+[general]
+port: %(port)d
+server_mode: %(mode)s
+%(extra)s
+"""
+
+
+class Daemon(object):
+
+    """Runs landiallerd.py in a scratch directory."""
+
+    def __init__(self, mode, options):
+        self.port = self._find_free_port()
+        self._dir = tempfile.mkdtemp()
+        extra = '\n'.join(['%s: %s' % option for option in options])
+        f = open(os.path.join(self._dir, 'landiallerd.conf'), 'w')
+        f.write(CONFIG % {'port': self.port, 'mode': mode, 'extra': extra})
+        f.close()
+        self._process = None
+        self.startup_seconds = None
+
+    def _find_free_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def start(self):
+        devnull = open(os.devnull, 'w')
+        started = time.time()
+        self._process = subprocess.Popen([sys.executable, SCRIPT, '-f'],
+                                         cwd=self._dir, stdout=devnull,
+                                         stderr=devnull)
+        devnull.close()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                try:
+                    sock.connect(('localhost', self.port))
+                    self.startup_seconds = time.time() - started
+                    return
+                except socket.error:
+                    time.sleep(0.01)
+            finally:
+                sock.close()
+        self.stop()
+        raise RuntimeError('landiallerd.py did not start listening')
+
+    def cpu_seconds(self):
+        """Return the user and system CPU time used by the daemon."""
+        f = open('/proc/%d/stat' % self._process.pid)
+        try:
+            fields = f.read().split(')')[-1].split()
+        finally:
+            f.close()
+        ticks = int(fields[11]) + int(fields[12])
+        return float(ticks) / os.sysconf('SC_CLK_TCK')
+
+    def stop(self):
+        if self._process is not None:
+            os.kill(self._process.pid, signal.SIGINT)
+            self._process.wait()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class Results(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.recording = False
+
+    def record(self, latency):
+        if self.recording:
+            self._lock.acquire()
+            try:
+                self.latencies.append(latency)
+            finally:
+                self._lock.release()
+
+    def record_error(self):
+        if self.recording:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        index = min(len(latencies) - 1, int(fraction * len(latencies)))
+        return latencies[index]
+
+
+class SimulatedClient(threading.Thread):
+
+    """Behaves like a LANdialler client left running on a desktop."""
+
+    RECONNECT_CHANCE = 0.01  # per poll
+
+    def __init__(self, number, port, interval, results, rng):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._client_id = 'bench-client-%d' % number
+        self._url = 'http://localhost:%d/' % port
+        self._interval = interval
+        self._results = results
+        self._random = random.Random(rng.random())
+        self.finished = threading.Event()
+
+    def _call(self, server, method, *args):
+        started = time.time()
+        try:
+            getattr(server, method)(*args)
+        except (socket.error, xmlrpclib.Error):
+            self._results.record_error()
+            return
+        self._results.record(time.time() - started)
+
+    def run(self):
+        server = xmlrpclib.ServerProxy(self._url)
+        self.finished.wait(self._random.uniform(0, self._interval))
+        self._call(server, 'connect', self._client_id)
+        while not self.finished.isSet():
+            self._call(server, 'get_status', self._client_id)
+            if self._random.random() < self.RECONNECT_CHANCE:
+                self._call(server, 'disconnect', self._client_id)
+                self._call(server, 'connect', self._client_id)
+            jitter = self._random.uniform(-0.1, 0.1) * self._interval
+            self.finished.wait(max(0, self._interval + jitter))
+
+
+def run_benchmark(clients, duration, interval, mode, options, seed, warm_up):
+    rng = random.Random(seed)
+    daemon = Daemon(mode, options)
+    daemon.start()
+    try:
+        results = Results()
+        threads = [SimulatedClient(i, daemon.port, interval, results, rng)
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(warm_up)
+        cpu_before = daemon.cpu_seconds()
+        results.recording = True
+        started = time.time()
+        time.sleep(duration)
+        results.recording = False
+        elapsed = time.time() - started
+        cpu_used = daemon.cpu_seconds() - cpu_before
+        for thread in threads:
+            thread.finished.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        daemon.stop()
+
+    requests = len(results.latencies)
+    print 'server mode:        %s' % mode
+    print 'clients:            %d' % clients
+    print 'startup time:       %.0f ms' % (daemon.startup_seconds * 1000)
+    print 'requests:           %d (%d errors)' % (requests, results.errors)
+    print 'requests/sec:       %.1f' % (requests / elapsed)
+    print 'p50 latency:        %.2f ms' % (results.percentile(0.5) * 1000)
+    print 'p99 latency:        %.2f ms' % (results.percentile(0.99) * 1000)
+    if requests:
+        print 'CPU per request:    %.3f ms' % (cpu_used * 1000 / requests)
+
+
+def main():
+    clients = 50
+    duration = 10.0
+    interval = 0.1
+    mode = 'single'
+    options = []
+    seed = 1
+    warm_up = 2.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:d:hi:m:o:s:w:')
+    except getopt.GetoptError, e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(2)
+    for o, v in opts:
+        if o == '-c':
+            clients = int(v)
+        elif o == '-d':
+            duration = float(v)
+        elif o == '-h':
+            print __doc__
+            return
+        elif o == '-i':
+            interval = float(v)
+        elif o == '-m':
+            mode = v
+        elif o == '-o':
+            key, value = v.split('=', 1)
+            options.append((key, value))
+        elif o == '-s':
+            seed = int(v)
+        elif o == '-w':
+            warm_up = float(v)
+    run_benchmark(clients, duration, interval, mode, options, seed, warm_up)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 # $Id: landiallerd_test.py,v 1.18 2004/10/03 10:28:58 ashtong Exp $
 
 
+import httplib
 import mock
+import os
+import StringIO
+import tempfile
 import time
 import unittest
 import threading
@@ -18,6 +22,102 @@ class MockTime:
     def time(self):
         return time.time() + self._offset
 
+    def monotonic(self):
+        if hasattr(time, 'monotonic'):
+            return time.monotonic() + self._offset
+        return os.times()[4] + self._offset
+
+
+class ListBackend:
+
+    def __init__(self):
+        self.messages = []
+        self.batches = 0
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+
+    def write(self, messages):
+        self.unblocked.wait()
+        self.batches += 1
+        self.messages.extend([msg for priority, msg in messages])
+
+
+class LoggerTest(unittest.TestCase):
+
+    def test_messages_written(self):
+        """Check messages are written by the background thread"""
+        backend = ListBackend()
+        logger = landiallerd.Logger(backend)
+        logger.info('one')
+        logger.warn('two')
+        logger.flush()
+        self.assertEqual(backend.messages, ['one', 'two'])
+
+    def test_unicode_message(self):
+        """Check messages with non-ASCII client ids are written"""
+        stream = StringIO.StringIO()
+        logger = landiallerd.Logger(landiallerd.StreamBackend(stream))
+        logger.info(u'J\xf6rg connected')
+        logger.info('done')
+        logger.flush()
+        lines = stream.getvalue().splitlines()
+        self.assert_(lines[0].endswith('J\xc3\xb6rg connected'))
+        self.assert_(lines[1].endswith('done'))
+
+    def test_repeats_coalesced(self):
+        """Check bursts of the same message are collapsed"""
+        backend = ListBackend()
+        backend.unblocked.clear()
+        logger = landiallerd.Logger(backend)
+        logger.info('first')
+        time.sleep(0.01)
+        for i in range(4):
+            logger.info('client-1 connected')
+        logger.info('done')
+        backend.unblocked.set()
+        logger.flush()
+        self.assertEqual(backend.messages,
+                         ['first', 'client-1 connected',
+                          'last message repeated 3 times', 'done'])
+
+    def test_drops_counted(self):
+        """Check messages are dropped rather than blocking"""
+        backend = ListBackend()
+        backend.unblocked.clear()
+        logger = landiallerd.Logger(backend, queue_size=2)
+        logger.info('first')
+        time.sleep(0.01)
+        for i in range(5):
+            logger.info('message %d' % i)
+        self.assertEqual(logger.dropped, 3)
+        backend.unblocked.set()
+        logger.flush()
+        logger.info('after')
+        logger.flush()
+        self.assert_('Log queue full, dropped 3 messages' in backend.messages)
+        self.assertEqual(backend.messages[-1], 'after')
+
+    def test_rate_limit(self):
+        """Check repeated messages can be rate limited"""
+        backend = ListBackend()
+        logger = landiallerd.Logger(backend, rate_limit=2)
+        for i in range(5):
+            logger.info('client-1 connected')
+            logger.flush()
+        logger.info('client-2 connected')
+        logger.flush()
+        self.assertEqual(backend.messages, ['client-1 connected',
+                                            'client-1 connected',
+                                            'client-2 connected'])
+        self.assertEqual(logger.suppressed, 3)
+
+    def test_stream_backend(self):
+        """Check messages can be written to a file"""
+        stream = StringIO.StringIO()
+        landiallerd.StreamBackend(stream).write(
+            [(landiallerd.syslog.LOG_WARNING, 'hello')])
+        self.assert_(stream.getvalue().endswith(' warning: hello\n'))
+
 
 class TimerTest(unittest.TestCase):
 
@@ -79,53 +179,119 @@ class TimerTest(unittest.TestCase):
         self.assertEqual(timer.is_running, False)
 
 
+class CountingProbe:
+
+    def __init__(self, value=True, delay=0):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return self.value
+
+
+class LinkStateCacheTest(unittest.TestCase):
+
+    def test_result_cached(self):
+        """Check the probe isn't rerun before the cache expires"""
+        probe = CountingProbe()
+        cache = landiallerd.LinkStateCache(probe, ttl=10)
+        self.assertEqual(cache.get(), True)
+        self.assertEqual(cache.get(), True)
+        self.assertEqual(probe.calls, 1)
+
+    def test_result_expires(self):
+        """Check the probe is rerun once the cache expires"""
+        probe = CountingProbe()
+        cache = landiallerd.LinkStateCache(probe, ttl=10)
+        cache.get()
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(11)
+            cache.get()
+            self.assertEqual(probe.calls, 2)
+        finally:
+            landiallerd.time = real_time
+
+    def test_zero_ttl(self):
+        """Check a zero TTL probes on every call"""
+        probe = CountingProbe()
+        cache = landiallerd.LinkStateCache(probe)
+        cache.get()
+        cache.get()
+        self.assertEqual(probe.calls, 2)
+
+    def test_invalidate(self):
+        """Check invalidating the cache forces a new probe"""
+        probe = CountingProbe()
+        cache = landiallerd.LinkStateCache(probe, ttl=10)
+        cache.get()
+        cache.invalidate()
+        probe.value = False
+        self.assertEqual(cache.get(), False)
+        self.assertEqual(probe.calls, 2)
+
+    def test_single_flight(self):
+        """Check concurrent callers share one probe"""
+        probe = CountingProbe(delay=0.05)
+        cache = landiallerd.LinkStateCache(probe)
+        results = []
+        def poll():
+            results.append(cache.get())
+        threads = [threading.Thread(target=poll) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(probe.calls, 1)
+
+
 class ModemTest(unittest.TestCase):
 
     SUCCESSFUL_COMMAND = 'ls / > /dev/null'
     FAILING_COMMAND = 'ls /missing.file 2> /dev/null'
 
     def test_dial(self):
-        """Check we can dial the modem and receive the return code"""
+        """Check we can dial the modem"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
-        modem = landiallerd.Modem(config)
-        try:
-            real_os = landiallerd.os
-            mock_os = mock.Mock()
-            landiallerd.os = mock_os
-            modem.connect()
-            command = mock_os.getNamedCalls('system')[0].getParam(0)
-            self.assertEqual(command, self.SUCCESSFUL_COMMAND)
-        finally:
-            landiallerd.os = real_os
+        runner = mock.Mock()
+        modem = landiallerd.Modem(config, runner=runner)
+        modem.connect()
+        call = runner.getNamedCalls('run')[0]
+        self.assertEqual(call.getParam(0), 'connect')
+        self.assertEqual(call.getParam(1).text, self.SUCCESSFUL_COMMAND)
 
     def test_disconnect(self):
-        """Check we can hang up the modem and receive the return code"""
+        """Check we can hang up the modem"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
-        modem = landiallerd.Modem(config)
-        try:
-            real_os = landiallerd.os
-            mock_os = mock.Mock()
-            landiallerd.os = mock_os
-            modem.disconnect()
-            command = mock_os.getNamedCalls('system')[0].getParam(0)
-            self.assertEqual(command, self.SUCCESSFUL_COMMAND)
-        finally:
-            landiallerd.os = real_os
+        runner = mock.Mock()
+        modem = landiallerd.Modem(config, runner=runner)
+        modem.disconnect()
+        call = runner.getNamedCalls('run')[0]
+        self.assertEqual(call.getParam(0), 'disconnect')
+        self.assertEqual(call.getParam(1).text, self.SUCCESSFUL_COMMAND)
 
     def test_is_connected(self):
         """Check we can test if we're connected"""
         config = mock.Mock({'get': self.SUCCESSFUL_COMMAND})
         modem = landiallerd.Modem(config)
-        try:
-            real_os = landiallerd.os
-            mock_os = mock.Mock({'system': 0})
-            landiallerd.os = mock_os
-            self.assertEqual(modem.is_connected(), True)
-            mock_os = mock.Mock({'system': 1})
-            landiallerd.os = mock_os
-            self.assertEqual(modem.is_connected(), False)
-        finally:
-            landiallerd.os = real_os
+        self.assertEqual(modem.is_connected(), True)
+        config = mock.Mock({'get': self.FAILING_COMMAND})
+        modem = landiallerd.Modem(config)
+        self.assertEqual(modem.is_connected(), False)
+
+    def test_configure(self):
+        """Check reloaded commands are used from then on"""
+        runner = mock.Mock()
+        modem = landiallerd.Modem(mock.Mock({'get': 'pon'}), runner=runner)
+        modem.configure(mock.Mock({'get': 'pon isdn'}))
+        modem.connect()
+        call = runner.getNamedCalls('run')[0]
+        self.assertEqual(call.getParam(1).text, 'pon isdn')
 
     def test_timer(self):
         """Check the timer is stopped when we hang up"""
@@ -161,11 +327,357 @@ class ModemTest(unittest.TestCase):
             landiallerd.time = real_time
         
 
+class LinkProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, text):
+        f = open(self.path, 'w')
+        f.write(text)
+        f.close()
+
+    def make_config(self, probe, interface='ppp0'):
+        config = landiallerd.ConfigParser.ConfigParser()
+        config.add_section('general')
+        config.set('general', 'link_probe', probe)
+        config.set('general', 'interface', interface)
+        return config
+
+    def test_command_probe_default(self):
+        """Check the is_connected command is used by default"""
+        probe = landiallerd.make_link_probe(mock.Mock())
+        self.assert_(isinstance(probe, landiallerd.CommandProbe))
+
+    def test_unknown_probe(self):
+        """Check an unknown probe name is rejected"""
+        config = self.make_config('telepathy')
+        self.assertRaises(ValueError, landiallerd.make_link_probe, config)
+
+    def test_sysfs_probe(self):
+        """Check the sysfs probe reads the interface's operstate"""
+        probe = landiallerd.make_link_probe(self.make_config('sysfs'))
+        probe._path = self.path
+        self.write('unknown\n')
+        self.assertEqual(probe(), True)
+        self.write('down\n')
+        self.assertEqual(probe(), False)
+        os.remove(self.path)
+        self.assertEqual(probe(), False)
+        self.write('')
+
+    def test_procfs_probe(self):
+        """Check the procfs probe looks for the interface"""
+        header = ('Inter-|   Receive\n'
+                  ' face |bytes    packets\n'
+                  '  eth0:  123 4 0 0 0 0 0 0 123 4 0 0 0 0 0 0\n')
+        probe = landiallerd.make_link_probe(self.make_config('procfs', 'lo'))
+        probe.PATH = self.path
+        self.write(header)
+        self.assertEqual(probe(), False)
+        self.write(header + '    lo:  567 8 0 0 0 0 0 0 567 8 0 0 0 0 0 0\n')
+        self.assertEqual(probe(), True)
+
+    def test_procfs_probe_no_address(self):
+        """Check the procfs probe waits for the interface's address"""
+        config = self.make_config('procfs', 'nosuchif0')
+        probe = landiallerd.make_link_probe(config)
+        probe.PATH = self.path
+        self.write('Inter-|   Receive\n'
+                   ' face |bytes    packets\n'
+                   'nosuchif0:  5 1 0 0 0 0 0 0 5 1 0 0 0 0 0 0\n')
+        self.assertEqual(probe(), False)
+
+    def test_link_section(self):
+        """Check a [link:NAME] section can choose its own probe"""
+        config = self.make_config('sysfs')
+        config.add_section('link:isdn')
+        config.set('link:isdn', 'link_probe', 'procfs')
+        config.set('link:isdn', 'interface', 'ippp0')
+        probe = landiallerd.make_link_probe(config, 'link:isdn')
+        self.assert_(isinstance(probe, landiallerd.ProcNetDevProbe))
+        self.assertEqual(probe._interface, 'ippp0')
+
+    def test_ioctl_probe(self):
+        """Check the ioctl probe finds addressed interfaces"""
+        probe = landiallerd.make_link_probe(self.make_config('ioctl', 'lo'))
+        self.assertEqual(probe(), True)
+        config = self.make_config('ioctl', 'nosuchif0')
+        self.assertEqual(landiallerd.make_link_probe(config)(), False)
+
+
+class IdleHangupTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.real_time = landiallerd.time
+        self.monitor = landiallerd.TrafficMonitor('ppp0', window=60)
+        self.monitor.PATH = self.path
+        self.modem = mock.Mock({'is_connected': True})
+        self.modem.timer = landiallerd.Timer()
+        self.proxy = landiallerd.ModemProxy(self.modem)
+        self.proxy.add_client('client-id-1')
+        self.thread = landiallerd.IdleHangupThread(self.proxy, self.monitor,
+                                                   threshold=100,
+                                                   idle_time=300)
+
+    def tearDown(self):
+        landiallerd.time = self.real_time
+        os.remove(self.path)
+
+    def sample(self, offset, total_bytes):
+        f = open(self.path, 'w')
+        f.write('Inter-|   Receive\n'
+                ' face |bytes    packets\n'
+                '  ppp0: %d 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0\n' % total_bytes)
+        f.close()
+        landiallerd.time = MockTime(offset)
+        self.thread.check()
+
+    def count_disconnects(self):
+        return len(self.modem.getNamedCalls('disconnect'))
+
+    def test_rate(self):
+        """Check the throughput is measured over the last window"""
+        self.sample(0, 0)
+        self.assertEqual(self.monitor.rate(), None)
+        self.sample(10, 100000)
+        self.assert_(abs(self.monitor.rate() - 10000) < 100)
+        for offset in range(20, 100, 10):
+            self.sample(offset, 100000)
+        self.assertEqual(self.monitor.rate(), 0)
+
+    def test_hangup_when_idle(self):
+        """Check the line is dropped once traffic stays low"""
+        self.sample(0, 1000)
+        self.sample(10, 1100)
+        self.sample(300, 1200)
+        self.assertEqual(self.count_disconnects(), 0)
+        self.sample(320, 1300)
+        self.assertEqual(self.count_disconnects(), 1)
+        self.assertEqual(self.proxy.state, self.proxy.HANGING_UP)
+        self.assertEqual(self.proxy.count_clients(), 1)
+
+    def test_busy_line_stays_up(self):
+        """Check the line stays up while traffic is flowing"""
+        for i in range(50):
+            self.sample(i * 10, i * 10000)
+        self.assertEqual(self.count_disconnects(), 0)
+
+
+class CommandTest(unittest.TestCase):
+
+    def test_pipeline_parsed(self):
+        """Check pipelines and redirections are split into argv lists"""
+        command = landiallerd.Command(
+            'is_connected',
+            '/sbin/ifconfig ppp0 2>/dev/null | grep "inet addr" >/dev/null')
+        self.assertEqual(command.pipeline, [
+            (['/sbin/ifconfig', 'ppp0'], [('2>', '/dev/null')]),
+            (['grep', 'inet addr'], [('>', '/dev/null')])])
+
+    def test_shell_syntax(self):
+        """Check commands that need a shell are left to /bin/sh"""
+        for text in ['exit 3', 'pon $PROVIDER', 'pon && sleep 1',
+                     'rm /tmp/*.pid', 'DEBUG=1 pon', 'pon >&2']:
+            self.assertEqual(landiallerd.Command('connect', text).pipeline,
+                             None)
+        self.assertEqual(landiallerd.Command('connect', 'exit 3').run(), 3)
+
+    def test_run_pipeline(self):
+        """Check a pipeline's exit status is that of its last command"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            command = landiallerd.Command('test', 'echo "inet addr" 2>&1 | '
+                                          'grep inet > %s' % path)
+            self.assertEqual(command.run(), 0)
+            self.assertEqual(open(path).read(), 'inet addr\n')
+            command = landiallerd.Command('test', 'echo a | grep b')
+            self.assertEqual(command.run(), 1)
+        finally:
+            os.remove(path)
+
+    def test_redirection_order(self):
+        """Check 2>&1 before a stdout redirection works as in the shell"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            text = ('sh -c "echo out; echo err >&2" > %s 2>&1 >/dev/null'
+                    % path)
+            self.assertEqual(landiallerd.Command('test', text).run(), 0)
+            self.assertEqual(open(path).read(), 'err\n')
+            text = 'sh -c "echo out; echo err >&2" > %s 2>&1' % path
+            command = landiallerd.Command('test', text)
+            self.assertNotEqual(command.pipeline, None)
+            self.assertEqual(command.run(), 0)
+            self.assertEqual(open(path).read(), 'out\nerr\n')
+        finally:
+            os.remove(path)
+
+    def test_missing_program(self):
+        """Check a program that can't be found fails like in the shell"""
+        command = landiallerd.Command('test', '/no/such/program | cat')
+        self.assertEqual(command.run(), 127)
+
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def test_command_not_waited_for(self):
+        """Check commands run in the background"""
+        runner = landiallerd.CommandRunner()
+        started = time.time()
+        child = runner.run('connect', 'sleep 1')
+        self.assert_(time.time() - started < 0.5)
+        self.assertEqual(runner.count_running(), 1)
+        child.kill(landiallerd.signal.SIGKILL)
+
+    def test_reap(self):
+        """Check finished commands are reaped"""
+        runner = landiallerd.CommandRunner()
+        child = runner.run('connect', 'exit 3')
+        while child.poll() is None:
+            time.sleep(0.01)
+        runner.reap()
+        self.assertEqual(runner.count_running(), 0)
+        self.assertEqual(child.poll(), 3)
+
+    def test_kill_on_timeout(self):
+        """Check commands that run for too long are killed"""
+        runner = landiallerd.CommandRunner(timeout=0)
+        child = runner.run('connect', 'sleep 10')
+        time.sleep(0.01)
+        runner.reap()
+        for i in range(100):
+            if child.poll() is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(child.poll(), -landiallerd.signal.SIGTERM)
+        runner.reap()
+        self.assertEqual(runner.count_running(), 0)
+
+
 class MockTimer:
 
     elapsed_seconds = 14
 
 
+class LinkModem:
+
+    """A modem that is connected once it has been dialled."""
+
+    def __init__(self, is_up=False):
+        self.is_up = is_up
+        self.calls = {'connect': 0, 'disconnect': 0}
+        self.timer = landiallerd.Timer()
+
+    def connect(self):
+        self.calls['connect'] += 1
+        self.is_up = True
+
+    def disconnect(self):
+        self.calls['disconnect'] += 1
+        self.is_up = False
+
+    def is_connected(self):
+        return self.is_up
+
+
+class ModemPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.modems = [LinkModem() for i in range(3)]
+        links = zip(['adsl', 'isdn', 'gprs'], self.modems)
+        self.pool = landiallerd.ModemPool(links, clients_per_link=2)
+        self.proxy = landiallerd.ModemProxy(self.pool)
+        self.proxy.links = self.pool
+
+    def count_calls(self, name):
+        return [modem.calls[name] for modem in self.modems]
+
+    def test_extra_links(self):
+        """Check links are brought up as clients arrive"""
+        for i in range(5):
+            self.proxy.add_client('client-id-%d' % i)
+        self.assertEqual(self.pool.count_active_links(), 3)
+        self.assertEqual(self.count_calls('connect'), [1, 1, 1])
+
+    def test_links_taken_down(self):
+        """Check the last link up is hung up when demand falls"""
+        for i in range(4):
+            self.proxy.add_client('client-id-%d' % i)
+        self.assertEqual(self.pool.count_active_links(), 2)
+        self.proxy.remove_client('client-id-0')
+        self.proxy.remove_client('client-id-1')
+        self.assertEqual(self.pool.count_active_links(), 1)
+        self.assertEqual(self.count_calls('disconnect'), [0, 1, 0])
+        self.proxy.remove_client('client-id-2')
+        self.proxy.remove_client('client-id-3')
+        self.assertEqual(self.pool.count_active_links(), 0)
+        self.assertEqual(self.count_calls('disconnect'), [1, 1, 0])
+
+    def test_connected_after_restart(self):
+        """Check a pool takes over links that are already up"""
+        self.modems[0].is_up = self.modems[1].is_up = True
+        pool = landiallerd.ModemPool(zip('abc', self.modems))
+        self.assertEqual(pool.is_connected(), True)
+        self.assertEqual(pool.count_active_links(), 2)
+
+
+class ClientRegistryTest(unittest.TestCase):
+
+    def test_client_details_recorded(self):
+        """Check the registry records what it knows about a client"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1', '192.168.0.2')
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(5)
+            record = registry.touch('client-id-1')
+        finally:
+            landiallerd.time = real_time
+        self.assertEqual(record.client_id, 'client-id-1')
+        self.assertEqual(record.address, '192.168.0.2')
+        self.assertEqual(record.polls, 2)
+        self.assert_(4 < record.last_seen - record.first_seen < 6)
+
+    def test_maximum_clients(self):
+        """Check the registry refuses clients once it is full"""
+        registry = landiallerd.ClientRegistry(30, max_clients=2)
+        registry.touch('client-id-1')
+        registry.touch('client-id-2')
+        self.assertRaises(landiallerd.RegistryFull,
+                          registry.touch, 'client-id-3')
+        registry.touch('client-id-2')
+        self.assertEqual(len(registry), 2)
+
+    def test_wall_clock_ignored(self):
+        """Check changing the system time doesn't expire clients"""
+        registry = landiallerd.ClientRegistry(30)
+        registry.touch('client-id-1')
+
+        class JumpingTime(MockTime):
+            def monotonic(self):
+                return MockTime(0).monotonic()
+
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = JumpingTime(3600)
+            self.assertEqual(registry.pop_expired(), [])
+        finally:
+            landiallerd.time = real_time
+
+    def test_records_are_slotted(self):
+        """Check client records don't carry a dictionary each"""
+        record = landiallerd.ClientRecord('client-id-1', None, 0)
+        self.failIf(hasattr(record, '__dict__'))
+
+
 class ModemProxyTest(unittest.TestCase):
 
     def test_dial_called_once(self):
@@ -193,11 +705,29 @@ class ModemProxyTest(unittest.TestCase):
         proxy = landiallerd.ModemProxy(modem)
         proxy.add_client('client-id-1')
         proxy.is_connected()
-        self.assertEqual(proxy._is_dialling, True)
+        self.assertEqual(proxy.state, proxy.DIALLING)
         modem = mock.Mock({'is_connected': True})
         proxy._modem = modem
         proxy.is_connected()
-        self.assertEqual(proxy._is_dialling, False)
+        self.assertEqual(proxy.state, proxy.CONNECTED)
+
+    def test_state_machine(self):
+        """Check the proxy follows the link through dialling and hang up"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        self.assertEqual(proxy.state, proxy.IDLE)
+        proxy.add_client('client-id-1')
+        self.assertEqual(proxy.state, proxy.DIALLING)
+        proxy._modem = mock.Mock({'is_connected': True})
+        proxy.is_connected()
+        self.assertEqual(proxy.state, proxy.CONNECTED)
+        proxy.remove_client('client-id-1')
+        self.assertEqual(proxy.state, proxy.HANGING_UP)
+        proxy.is_connected()
+        self.assertEqual(proxy.state, proxy.HANGING_UP)
+        proxy._modem = mock.Mock({'is_connected': False})
+        proxy.is_connected()
+        self.assertEqual(proxy.state, proxy.IDLE)
 
     def test_dont_dial_if_connected(self):
         """Check proxy doesn't dial up if modem connected"""
@@ -216,6 +746,84 @@ class ModemProxyTest(unittest.TestCase):
         proxy = landiallerd.ModemProxy(modem)
         self.failIf(proxy.is_connected())
 
+    def test_link_state_cached(self):
+        """Check the proxy reuses the link state within the TTL"""
+        modem = mock.Mock({'is_connected': True})
+        proxy = landiallerd.ModemProxy(modem, status_ttl=10)
+        proxy.is_connected()
+        proxy.is_connected()
+        self.assertEqual(len(modem.getNamedCalls('is_connected')), 1)
+
+    def test_concurrent_clients_dial_once(self):
+        """Check clients connecting at once only dial the modem once"""
+        class SlowModem:
+            connects = 0
+            def is_connected(self):
+                time.sleep(0.01)
+                return False
+            def connect(self):
+                self.connects += 1
+        modem = SlowModem()
+        proxy = landiallerd.ModemProxy(modem)
+        threads = [threading.Thread(target=proxy.add_client, args=(i,))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(modem.connects, 1)
+        self.assertEqual(proxy.count_clients(), 5)
+
+    def make_blocking_modem(self):
+        class BlockingModem:
+            probing = threading.Event()
+            finished = threading.Event()
+            timer = MockTimer()
+            def is_connected(self):
+                self.probing.set()
+                self.finished.wait(5)
+                return True
+            def connect(self):
+                pass
+            def disconnect(self):
+                pass
+        return BlockingModem()
+
+    def check_not_held_up(self, proxy, method, *args):
+        thread = threading.Thread(target=method, args=args)
+        thread.start()
+        try:
+            self.assert_(proxy._modem.probing.wait(5) is not False)
+            started = time.time()
+            proxy.refresh_client('client-id-2')
+            self.assert_(time.time() - started < 1)
+        finally:
+            proxy._modem.finished.set()
+            thread.join()
+
+    def test_probe_outside_lock(self):
+        """Check a slow link probe doesn't hold up other clients"""
+        proxy = landiallerd.ModemProxy(self.make_blocking_modem())
+        self.check_not_held_up(proxy, proxy.add_client, 'client-id-1')
+        proxy = landiallerd.ModemProxy(self.make_blocking_modem())
+        proxy.refresh_client('client-id-1')
+        self.check_not_held_up(proxy, proxy.remove_client, 'client-id-1')
+        proxy.remove_client('client-id-2')
+        self.assertEqual(proxy.state, proxy.HANGING_UP)
+
+    def test_monitored_proxy_uses_snapshot(self):
+        """Check a monitored proxy doesn't probe the link for clients"""
+        modem = mock.Mock({'is_connected': False})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.update_status()
+        proxy.is_monitored = True
+        proxy.add_client('client-id-1')
+        proxy.remove_client('client-id-1')
+        self.assertEqual(len(modem.getNamedCalls('is_connected')), 1)
+        self.assertEqual(len(modem.getNamedCalls('connect')), 1)
+        self.assertEqual(len(modem.getNamedCalls('disconnect')), 1)
+
     def test_client_counting(self):
         """Check proxy keeps track of number of connected clients"""
         modem = mock.Mock({'is_connected': True})
@@ -264,6 +872,74 @@ class ModemProxyTest(unittest.TestCase):
         proxy = landiallerd.ModemProxy(modem)
         self.assertEqual(proxy.get_time_connected(), 14)
 
+    def test_hangup_delay(self):
+        """Check a client toggling connect doesn't make the modem flap"""
+        modem = mock.Mock({'is_connected': True})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.hangup_delay = 10
+        for i in range(5):
+            proxy.add_client('client-id-1')
+            proxy.remove_client('client-id-1')
+        self.assertEqual(len(modem.getNamedCalls('disconnect')), 0)
+        self.assertEqual(proxy.next_expiry() <= 10, True)
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(10)
+            proxy.hang_up_if_due()
+        finally:
+            landiallerd.time = real_time
+        self.assertEqual(len(modem.getNamedCalls('disconnect')), 1)
+        self.assertEqual(proxy.state, proxy.HANGING_UP)
+
+    def test_redial(self):
+        """Check failed dials are retried and then given up on"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.dial_timeout = 30
+        proxy.max_dial_attempts = 2
+        proxy.redial_delay = 10
+        proxy.add_client('client-id-1')
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(30)
+            proxy.check_dialling()
+            attempt, redial_in = proxy.get_dial_status()
+            self.assertEqual(attempt, 1)
+            self.assert_(4 < redial_in <= 10)
+            self.assertEqual(len(modem.getNamedCalls('disconnect')), 1)
+            landiallerd.time = MockTime(41)
+            proxy.check_dialling()
+            self.assertEqual(len(modem.getNamedCalls('connect')), 2)
+            self.assertEqual(proxy.get_dial_status(), (2, None))
+            landiallerd.time = MockTime(72)
+            proxy.check_dialling()
+            self.assertEqual(proxy.state, proxy.IDLE)
+            self.assertEqual(len(modem.getNamedCalls('disconnect')), 2)
+        finally:
+            landiallerd.time = real_time
+        proxy.add_client('client-id-1')
+        self.assertEqual(proxy.state, proxy.DIALLING)
+        self.assertEqual(len(modem.getNamedCalls('connect')), 3)
+
+    def test_restored_dial_times_out(self):
+        """Check a dial under way before a restart can still fail"""
+        modem = mock.Mock({'is_connected': False})
+        modem.timer = landiallerd.Timer()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.dial_timeout = 30
+        saved = landiallerd.SavedState()
+        saved.state = proxy.DIALLING
+        proxy.restore(saved)
+        self.assertEqual(proxy.get_dial_status(), (1, None))
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(30)
+            proxy.check_dialling()
+            self.assertEqual(len(modem.getNamedCalls('disconnect')), 1)
+            self.assertNotEqual(proxy.get_dial_status()[1], None)
+        finally:
+            landiallerd.time = real_time
+
     def test_forget_old_clients(self):
         """Check the proxy forgets about old clients"""
         modem = mock.Mock()
@@ -295,6 +971,50 @@ class ModemProxyTest(unittest.TestCase):
         finally:
             landiallerd.time = real_time
         
+    def test_next_expiry(self):
+        """Check the proxy knows when the next client will time out"""
+        modem = mock.Mock()
+        proxy = landiallerd.ModemProxy(modem)
+        self.assertEqual(proxy.next_expiry(), None)
+        proxy.add_client('client-id-1')
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(10)
+            proxy.add_client('client-id-2')
+            self.assert_(19 < proxy.next_expiry() <= 20)
+            proxy.refresh_client('client-id-1')
+            self.assert_(29 < proxy.next_expiry() <= 30)
+            landiallerd.time = MockTime(50)
+            self.assertEqual(proxy.next_expiry(), 0)
+        finally:
+            landiallerd.time = real_time
+
+    def test_only_expired_clients_removed(self):
+        """Check refreshed clients survive an expiry sweep"""
+        modem = mock.Mock()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        proxy.add_client('client-id-2')
+        try:
+            real_time = landiallerd.time
+            landiallerd.time = MockTime(20)
+            proxy.refresh_client('client-id-2')
+            landiallerd.time = MockTime(landiallerd.ModemProxy.CLIENT_TIMEOUT)
+            proxy.remove_old_clients()
+            self.assertEqual(proxy.count_clients(), 1)
+            self.assertEqual(proxy.next_expiry() > 0, True)
+        finally:
+            landiallerd.time = real_time
+
+    def test_expiry_index_bounded(self):
+        """Check refreshing clients doesn't grow the expiry index forever"""
+        modem = mock.Mock()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        for i in range(1000):
+            proxy.refresh_client('client-id-1')
+        self.assert_(len(proxy._clients._expiry) < 100)
+
     def test_refresh_client(self):
         """Check refreshing a client updates time client was last seen"""
         modem = mock.Mock()
@@ -312,6 +1032,282 @@ class ModemProxyTest(unittest.TestCase):
             landiallerd.time = real_time
 
 
+class StateJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state')
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def make_proxy(self, is_connected=True):
+        modem = mock.Mock({'is_connected': is_connected})
+        modem.timer = landiallerd.Timer()
+        return landiallerd.ModemProxy(modem)
+
+    def test_restart(self):
+        """Check a restarted proxy remembers its clients and state"""
+        journal = landiallerd.StateJournal(self.path)
+        proxy = self.make_proxy()
+        proxy.journal = journal
+        proxy._modem.timer.start()
+        proxy.add_client('client 1', '192.168.0.2')
+        proxy.add_client('client-id-2')
+        proxy.remove_client('client-id-2')
+        journal.sync()
+
+        restarted = self.make_proxy()
+        restarted.restore(landiallerd.StateJournal(self.path).load())
+        self.assertEqual(restarted.count_clients(), 1)
+        self.assertEqual(restarted.get_client('client 1').address,
+                         '192.168.0.2')
+        self.assertEqual(restarted.state, restarted.CONNECTED)
+        self.assertEqual(restarted._modem.timer.is_running, True)
+        self.assertEqual(restarted._modem.timer.start_time,
+                         proxy._modem.timer.start_time)
+
+    def test_non_ascii_client_id(self):
+        """Check non-ASCII client ids are saved and restored"""
+        journal = landiallerd.StateJournal(self.path)
+        proxy = self.make_proxy()
+        proxy.journal = journal
+        proxy.add_client(u'caf\xe9')
+        proxy.add_client(u'na\xefve')
+        proxy.remove_client(u'na\xefve')
+        proxy.add_client('client-id-1')
+        journal.sync()
+        restarted = self.make_proxy()
+        restarted.restore(journal.load())
+        self.assertEqual(sorted(restarted.client_ids()),
+                         [u'caf\xe9', 'client-id-1'])
+        proxy.save(journal)
+        self.assertEqual(len(journal.load().clients), 2)
+
+    def test_compact_outside_lock(self):
+        """Check clients aren't held up while the journal is compacted"""
+        proxy = self.make_proxy()
+        class SlowJournal(landiallerd.StateJournal):
+            def compact(journal, snapshot):
+                thread = threading.Thread(target=proxy.refresh_client,
+                                          args=('client-id-2',))
+                thread.start()
+                thread.join(1)
+                self.failIf(thread.isAlive())
+                landiallerd.StateJournal.compact(journal, snapshot)
+        journal = SlowJournal(self.path)
+        proxy.journal = journal
+        proxy.add_client('client-id-1')
+        proxy.save(journal)
+        self.assertEqual(len(journal.load().clients), 1)
+
+    def test_stopped_timer_restored(self):
+        """Check a finished session's length survives a restart"""
+        journal = landiallerd.StateJournal(self.path)
+        timer = landiallerd.Timer()
+        real_time = landiallerd.time
+        try:
+            landiallerd.time = MockTime(-3660)
+            timer.start()
+            landiallerd.time = MockTime(-3600)
+            timer.stop()
+        finally:
+            landiallerd.time = real_time
+        journal.state_changed('idle', timer)
+        journal.sync()
+        restarted = self.make_proxy(False)
+        restarted.restore(journal.load())
+        self.assertEqual(restarted._modem.timer.is_running, False)
+        self.assertEqual(restarted.get_time_connected(), 60)
+
+    def test_compact(self):
+        """Check compacting the journal keeps only the current state"""
+        journal = landiallerd.StateJournal(self.path)
+        proxy = self.make_proxy()
+        proxy.journal = journal
+        for i in range(10):
+            proxy.add_client('client-id-%d' % i)
+        for i in range(9):
+            proxy.remove_client('client-id-%d' % i)
+        journal.sync()
+        proxy.save(journal)
+        lines = open(self.path).readlines()
+        self.assertEqual(len(lines), 3)
+        saved = journal.load()
+        self.assertEqual([r.client_id for r in saved.clients], ['client-id-9'])
+
+    def test_restored_clients_expire(self):
+        """Check restored clients still time out"""
+        journal = landiallerd.StateJournal(self.path)
+        proxy = self.make_proxy()
+        proxy.journal = journal
+        proxy.add_client('client-id-1')
+        journal.sync()
+        restarted = self.make_proxy()
+        restarted.restore(journal.load())
+        try:
+            # Saved times are rounded, so allow a little slack.
+            real_time = landiallerd.time
+            timeout = landiallerd.ModemProxy.CLIENT_TIMEOUT
+            landiallerd.time = MockTime(timeout + 1)
+            restarted.remove_old_clients()
+            self.assertEqual(restarted.count_clients(), 0)
+        finally:
+            landiallerd.time = real_time
+
+    def test_polling_clients_survive_restart(self):
+        """Check clients that kept polling aren't dropped after a restart"""
+        journal = landiallerd.StateJournal(self.path)
+        proxy = self.make_proxy()
+        proxy.journal = journal
+        real_time = landiallerd.time
+        try:
+            landiallerd.time = MockTime(-600)
+            proxy.add_client('client-id-1')
+        finally:
+            landiallerd.time = real_time
+        proxy.refresh_client('client-id-1')
+        journal.sync()
+        restarted = self.make_proxy()
+        restarted.restore(journal.load())
+        restarted.remove_old_clients()
+        self.assertEqual(restarted.count_clients(), 1)
+        self.assertEqual(len(restarted._modem.getNamedCalls('disconnect')), 0)
+
+    def test_missing_journal(self):
+        """Check a missing journal file means a fresh start"""
+        saved = landiallerd.StateJournal(self.path).load()
+        self.assertEqual(saved.clients, [])
+        self.assertEqual(saved.state, None)
+
+    def test_truncated_journal(self):
+        """Check a partly written record is ignored"""
+        f = open(self.path, 'w')
+        f.write('state connected\ntimer 12')
+        f.close()
+        saved = landiallerd.StateJournal(self.path).load()
+        self.assertEqual(saved.state, 'connected')
+        self.assertEqual(saved.start_time, None)
+
+
+class UsageDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = landiallerd.UsageDatabase(':memory:')
+
+    def local_time(self, *date):
+        return time.mktime(date + (0, 0, -1))
+
+    def test_daily_rollup(self):
+        """Check sessions are added up by day and by month"""
+        start = self.local_time(2004, 10, 3, 9, 0, 0)
+        self.db.record_session(start, start + 600, 1000, 100, ['a'])
+        self.db.record_session(start + 3600, start + 3900, 500, 50, ['a', 'b'])
+        day, = self.db.get_usage('day', 12)
+        self.assertEqual(day['period'], '2004-10-03')
+        self.assertEqual(day['sessions'], 2)
+        self.assertEqual(day['seconds'], 900)
+        self.assertEqual(day['rx_bytes'], 1500)
+        self.assertEqual(day['tx_bytes'], 150)
+        month, = self.db.get_usage('month', 12)
+        self.assertEqual(month['period'], '2004-10')
+        self.assertEqual(month['seconds'], 900)
+
+    def test_session_over_midnight(self):
+        """Check a session over midnight is split between the days"""
+        start = self.local_time(2004, 10, 31, 23, 30, 0)
+        self.db.record_session(start, start + 3600, 2000, 0, ['a'])
+        days = self.db.get_usage('day', 12)
+        self.assertEqual([d['period'] for d in days],
+                         ['2004-11-01', '2004-10-31'])
+        self.assertEqual([d['seconds'] for d in days], [1800, 1800])
+        self.assertEqual([d['rx_bytes'] for d in days], [1000, 1000])
+        self.assertEqual([d['sessions'] for d in days], [0, 1])
+        months = self.db.get_usage('month', 1)
+        self.assertEqual(len(months), 1)
+        self.assertEqual(months[0]['period'], '2004-11')
+
+    def test_unknown_period(self):
+        """Check an unknown period is rejected"""
+        self.assertRaises(ValueError, self.db.get_usage, 'fortnight', 1)
+
+    def test_accounting(self):
+        """Check a proxy records each session as it ends"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = landiallerd.Timer()
+        modem.timer.start()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.accounting = landiallerd.UsageAccountant(self.db, 'nosuchif0')
+        proxy.add_client('client-id-1')
+        proxy.add_client('client-id-2')
+        proxy.remove_client('client-id-1')
+        proxy.remove_client('client-id-2')
+        proxy.accounting.flush()
+        sessions = self.db._db.execute(
+            'SELECT clients FROM sessions').fetchall()
+        self.assertEqual(sessions, [('client-id-1,client-id-2',)])
+
+    def test_non_ascii_client_id(self):
+        """Check a session shared with a non-ASCII client id is recorded"""
+        accountant = landiallerd.UsageAccountant(self.db, 'nosuchif0')
+        accountant.session_started(time.time() - 60, [u'caf\xe9'])
+        accountant.session_ended()
+        accountant.flush()
+        sessions = self.db._db.execute(
+            'SELECT clients FROM sessions').fetchall()
+        self.assertEqual(sessions, [('caf%C3%A9',)])
+
+    def test_recorded_in_background(self):
+        """Check the session isn't written by the thread that ends it"""
+        release = threading.Event()
+        threads = []
+        def record_session(*args):
+            threads.append(threading.currentThread())
+            release.wait(5)
+        database = mock.Mock()
+        database.record_session = record_session
+        accountant = landiallerd.UsageAccountant(database, 'nosuchif0')
+        accountant.session_started(time.time() - 60, ['client-id-1'])
+        accountant.session_ended()  # would block if written here
+        release.set()
+        accountant.flush()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.currentThread())
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.real_time = landiallerd.time
+        landiallerd.time = MockTime(0)
+
+    def tearDown(self):
+        landiallerd.time = self.real_time
+
+    def test_burst(self):
+        """Check a burst is allowed and then the rate is enforced"""
+        limiter = landiallerd.RateLimiter(rate=1, burst=3)
+        results = [limiter.allow('client-id-1') for i in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+        self.assertEqual(limiter.allow('client-id-2'), True)
+        landiallerd.time = MockTime(2)
+        self.assertEqual(limiter.allow('client-id-1'), True)
+        self.assertEqual(limiter.allow('client-id-1'), True)
+        self.assertEqual(limiter.allow('client-id-1'), False)
+
+    def test_idle_keys_forgotten(self):
+        """Check the limiter doesn't grow without bound"""
+        limiter = landiallerd.RateLimiter(rate=1, burst=1)
+        limiter.MAX_KEYS = 10
+        for i in range(10):
+            limiter.allow(i)
+        landiallerd.time = MockTime(5)
+        limiter.allow('client-id-1')
+        self.assertEqual(len(limiter._buckets), 1)
+
+
 class APITest(unittest.TestCase):
 
     def test_connect_return_code(self):
@@ -321,6 +1317,48 @@ class APITest(unittest.TestCase):
         api = landiallerd.API(proxy)
         self.assertEqual(api.connect('client-id-1'), True)
 
+    def test_rate_limited(self):
+        """Check a client making too many calls is turned away"""
+        modem = mock.Mock({'is_connected': False})
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        api.client_limiter = landiallerd.RateLimiter(0, 2)
+        api.connect('client-id-1')
+        api.disconnect('client-id-1')
+        self.assertRaises(landiallerd.RateLimited, api.connect, 'client-id-1')
+        self.assertEqual(len(modem.getNamedCalls('connect')), 1)
+        self.assertEqual(api.connect('client-id-2'), True)
+
+    def test_batch_rate_limited(self):
+        """Check get_status_many() charges each client in the batch"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        api.client_limiter = landiallerd.RateLimiter(0, 2)
+        api.get_status('client-id-1')
+        api.get_status_many(['client-id-1', 'client-id-2'])
+        self.assertRaises(landiallerd.RateLimited, api.get_status_many,
+                          ['client-id-2', 'client-id-1'])
+        self.assertEqual(api.get_status_many(['client-id-3']), [(3, True, 14)])
+
+    def test_get_extended_status(self):
+        """Check get_extended_status() shows the dial in progress"""
+        modem = mock.Mock({'is_connected': False})
+        modem.timer = MockTimer()
+        api = landiallerd.API(landiallerd.ModemProxy(modem))
+        api.connect('client-id-1')
+        status = api.get_extended_status('client-id-1')
+        self.assertEqual(status['state'], 'dialling')
+        self.assertEqual(status['dial_attempt'], 1)
+        self.assertEqual(status['redial_in'], -1)
+        self.assertEqual(status['current_clients'], 1)
+
+    def test_get_usage_disabled(self):
+        """Check get_usage() fails when accounting is turned off"""
+        api = landiallerd.API(landiallerd.ModemProxy(mock.Mock()))
+        self.assertRaises(xmlrpclib.Fault, api.get_usage, 'day')
+
     def test_disconnect_return_code(self):
         """Check disconnect() returns True"""
         modem = mock.Mock()
@@ -394,6 +1432,14 @@ class APITest(unittest.TestCase):
         finally:
             landiallerd.time = real_time
 
+    def test_too_many_clients(self):
+        """Check connect() faults when there are too many clients"""
+        modem = mock.Mock({'is_connected': True})
+        proxy = landiallerd.ModemProxy(modem, max_clients=1)
+        api = landiallerd.API(proxy)
+        api.connect('client-id-1')
+        self.assertRaises(xmlrpclib.Fault, api.connect, 'client-id-2')
+
     def test_get_num_clients(self):
         """Check get_status() returns number of clients"""
         modem = mock.Mock({'is_connected': True})
@@ -419,6 +1465,16 @@ class APITest(unittest.TestCase):
         api = landiallerd.API(proxy)
         self.assertEqual(api.get_status('client-id-1')[1], xmlrpclib.False)
         
+    def test_get_status_many(self):
+        """Check get_status_many() refreshes every client at once"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        statuses = api.get_status_many(['client-id-1', 'client-id-2'])
+        self.assertEqual(statuses, [(2, True, 14), (2, True, 14)])
+        self.assertEqual(len(modem.getNamedCalls('is_connected')), 1)
+
     def test_get_time_online(self):
         """Check get_status() returns time online"""
         modem = mock.Mock()
@@ -478,6 +1534,25 @@ class AutoDisconnecThreadTest(unittest.TestCase):
         thread.finished.set()
         self.assert_(len(modem.getNamedCalls('is_connected')) > 0)
 
+    def test_woken_for_hangup(self):
+        """Check a delayed hangup isn't held up by a sleeping thread"""
+        modem = mock.Mock({'is_connected': True})
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.hangup_delay = 0.05
+        proxy.add_client('client-id')
+        thread = landiallerd.AutoDisconnectThread(proxy)
+        thread.start()
+        try:
+            self.let_thread_work()
+            proxy.remove_client('client-id')
+            for i in range(50):
+                if modem.getNamedCalls('disconnect'):
+                    break
+                time.sleep(0.01)
+            self.assertEqual(len(modem.getNamedCalls('disconnect')), 1)
+        finally:
+            thread.finished.set()
+
     def test_daemon_thread(self):
         """Check the auto disconnect thread is a daemon thread"""
         modem = mock.Mock()
@@ -504,5 +1579,584 @@ class AutoDisconnecThreadTest(unittest.TestCase):
             landiallerd.time = real_time
         
 
+class LinkMonitorThreadTest(unittest.TestCase):
+
+    def start_monitor(self, proxy, period=0.01):
+        thread = landiallerd.LinkMonitorThread(proxy, period)
+        thread.start()
+        time.sleep(0.02)
+        return thread
+
+    def stop_monitor(self, thread):
+        thread.finished.set()
+        thread.join()
+
+    def test_status_from_snapshot(self):
+        """Check get_status() doesn't probe the link while monitored"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        thread = self.start_monitor(proxy, period=10)
+        try:
+            self.assert_(proxy.is_monitored)
+            api = landiallerd.API(proxy)
+            modem.getNamedCalls('is_connected')[:] = []
+            self.assertEqual(api.get_status('client-id-1'), (1, True, 14))
+            self.assertEqual(len(modem.getNamedCalls('is_connected')), 0)
+        finally:
+            self.stop_monitor(thread)
+        self.failIf(proxy.is_monitored)
+
+    def test_wait_for_status_change(self):
+        """Check waiting clients are woken when the status changes"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        thread = self.start_monitor(proxy, period=10)
+        try:
+            version = api.wait_for_status_change('client-id-1', 0, 0)[0]
+            results = []
+            def wait():
+                results.append(api.wait_for_status_change('client-id-1',
+                                                          version, 5))
+            waiter = threading.Thread(target=wait)
+            started = time.time()
+            waiter.start()
+            time.sleep(0.01)
+            proxy.add_client('client-id-2')
+            waiter.join()
+            self.assert_(time.time() - started < 1)
+            self.assertEqual(results[0], (version + 1, 2, True, 14))
+        finally:
+            self.stop_monitor(thread)
+
+    def test_unmonitored_waiters_woken(self):
+        """Check waiters hear about new clients without a monitor"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        version = api.wait_for_status_change('client-id-1', 0, 0)[0]
+        results = []
+        def wait():
+            results.append(api.wait_for_status_change('client-id-1',
+                                                      version, 5))
+        waiter = threading.Thread(target=wait)
+        started = time.time()
+        waiter.start()
+        time.sleep(0.01)
+        proxy.add_client('client-id-2')
+        waiter.join()
+        self.assert_(time.time() - started < 1)
+        self.assertEqual(results[0][:2], (version + 1, 2))
+
+    def test_wait_times_out(self):
+        """Check waiting returns after the timeout with no change"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy)
+        version = api.wait_for_status_change('client-id-1', 0, 0)[0]
+        status = api.wait_for_status_change('client-id-1', version, 0.01)
+        self.assertEqual(status, (version, 1, True, 14))
+
+    def test_wait_limited(self):
+        """Check the API won't wait for longer than max_wait"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy, max_wait=0.01)
+        version = api.wait_for_status_change('client-id-1', 0, 0)[0]
+        started = time.time()
+        api.wait_for_status_change('client-id-1', version, 10)
+        self.assert_(time.time() - started < 1)
+
+    def test_wait_not_supported(self):
+        """Check clients are told to poll when the server can't wait"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(proxy, max_wait=0)
+        try:
+            api.wait_for_status_change('client-id-1', 0, 0)
+            self.fail('expected a fault')
+        except xmlrpclib.Fault, fault:
+            self.assertEqual(fault.faultCode, 5)
+
+    def test_client_count_published(self):
+        """Check adding a client updates the snapshot immediately"""
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        thread = self.start_monitor(proxy)
+        try:
+            proxy.add_client('client-id-1')
+            proxy.add_client('client-id-2')
+            self.assertEqual(proxy.get_status()[0], 2)
+        finally:
+            self.stop_monitor(thread)
+
+    def test_monitor_ends_dialling(self):
+        """Check the monitor notices when dialling has completed"""
+        modem = mock.Mock({'is_connected': False})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        proxy.add_client('client-id-1')
+        self.assertEqual(proxy.state, proxy.DIALLING)
+        proxy._modem = mock.Mock({'is_connected': True})
+        proxy._modem.timer = MockTimer()
+        thread = self.start_monitor(proxy)
+        try:
+            self.assertEqual(proxy.state, proxy.CONNECTED)
+        finally:
+            self.stop_monitor(thread)
+
+
+class ReloadTest(unittest.TestCase):
+
+    CONFIG = """[commands]
+connect: %s
+disconnect: true
+is_connected: false
+
+[general]
+port: 6543
+status_cache_ttl: %s
+"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.write_config(self.CONFIG % ('true', 2))
+        self.app = landiallerd.App()
+
+    def tearDown(self):
+        if self.app._monitor is not None:
+            self.app._monitor.finished.set()
+            self.app._monitor.join()
+        os.chdir(self.cwd)
+        os.remove(os.path.join(self.dir, 'landiallerd.conf'))
+        os.rmdir(self.dir)
+
+    def write_config(self, text):
+        f = open('landiallerd.conf', 'w')
+        f.write(text)
+        f.close()
+
+    def test_reload(self):
+        """Check a reload keeps the clients and uses the new settings"""
+        self.app._modem_proxy.add_client('client-id-1')
+        self.write_config(self.CONFIG % ('pon isdn', 5))
+        self.app.reload()
+        self.assertEqual(self.app._modem.commands.connect.text, 'pon isdn')
+        self.assertEqual(self.app._modem_proxy._link_state.ttl, 5)
+        self.assertEqual(self.app._modem_proxy.count_clients(), 1)
+
+    def test_bad_config(self):
+        """Check a broken config file is not half loaded"""
+        self.write_config('[general]\nstatus_cache_ttl: 5\n')
+        self.app.reload()
+        self.assertEqual(self.app._modem.commands.connect.text, 'true')
+        self.assertEqual(self.app._modem_proxy._link_state.ttl, 2)
+
+    def test_single_mode_doesnt_wait(self):
+        """Check the single server tells long polling clients to poll"""
+        api = landiallerd.API(self.app._modem_proxy, self.app._get_max_wait())
+        self.assertRaises(xmlrpclib.Fault, api.wait_for_status_change,
+                          'client-id-1', 0, 10)
+
+    def test_bad_option(self):
+        """Check nothing is changed if any option is invalid"""
+        self.write_config(self.CONFIG % ('pon isdn', 5) +
+                          'max_clients: lots\n')
+        self.app.reload()
+        self.assertEqual(self.app._modem.commands.connect.text, 'true')
+        self.assertEqual(self.app._modem_proxy._link_state.ttl, 2)
+
+
+class ServerModeTest(unittest.TestCase):
+
+    def check_server(self, server):
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem)
+        server.register_instance(landiallerd.API(proxy))
+        server.register_multicall_functions()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            url = 'http://localhost:%d/' % server.server_address[1]
+            client = xmlrpclib.ServerProxy(url)
+            self.assertEqual(client.connect('client-id-1'), True)
+            self.assertEqual(client.get_status('client-id-1'), [1, True, 14])
+            record = proxy.get_client('client-id-1')
+            self.assertEqual(record.address, '127.0.0.1')
+            multicall = xmlrpclib.MultiCall(client)
+            multicall.get_status('client-id-1')
+            multicall.get_status_many(['client-id-2'])
+            results = tuple(multicall())
+            self.assertEqual(results, ([1, True, 14], [[2, True, 14]]))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_threading_server(self):
+        """Check the threading server answers requests"""
+        server = landiallerd.ThreadingXMLRPCServer(('localhost', 0),
+                                                   logRequests=False)
+        self.check_server(server)
+
+    def test_pooled_server(self):
+        """Check the pooled server answers requests"""
+        server = landiallerd.PooledXMLRPCServer(('localhost', 0), 2,
+                                                logRequests=False)
+        self.check_server(server)
+
+    def test_async_server(self):
+        """Check the event loop server answers requests"""
+        server = landiallerd.AsyncXMLRPCServer(('localhost', 0))
+        self.check_server(server)
+
+    def test_prebound_socket(self):
+        """Check the servers answer on a socket that is already bound"""
+        for server_class in (landiallerd.ReusableSimpleXMLRPCServer,
+                             landiallerd.ThreadingXMLRPCServer,
+                             landiallerd.AsyncXMLRPCServer):
+            sock = landiallerd.listening_socket(('localhost', 0))
+            port = sock.getsockname()[1]
+            server = server_class(None, logRequests=False, sock=sock)
+            self.assertEqual(server.server_address[1], port)
+            self.check_server(server)
+
+    def test_async_server_rejects_get(self):
+        """Check the event loop server only accepts POST requests"""
+        server = landiallerd.AsyncXMLRPCServer(('localhost', 0))
+        thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            conn = httplib.HTTPConnection('localhost', server.server_address[1])
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().status, 501)
+            conn.close()
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class SocketActivationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = landiallerd.listening_socket(('localhost', 0))
+        self.fd = os.dup(self.listener.fileno())
+
+    def tearDown(self):
+        for name in ('LISTEN_PID', 'LISTEN_FDS'):
+            os.environ.pop(name, None)
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        self.listener.close()
+
+    def test_activated(self):
+        """Check the socket passed by the service manager is used"""
+        os.environ['LISTEN_PID'] = str(os.getpid())
+        os.environ['LISTEN_FDS'] = '1'
+        sock = landiallerd.get_activated_socket(self.fd)
+        self.assertEqual(sock.getsockname(), self.listener.getsockname())
+        self.failIf('LISTEN_PID' in os.environ)
+        self.failIf('LISTEN_FDS' in os.environ)
+        sock.close()
+
+    def test_other_process(self):
+        """Check sockets meant for another process are left alone"""
+        os.environ['LISTEN_PID'] = str(os.getpid() + 1)
+        os.environ['LISTEN_FDS'] = '1'
+        self.assertEqual(landiallerd.get_activated_socket(self.fd), None)
+        self.failUnless('LISTEN_FDS' in os.environ)
+
+    def test_not_activated(self):
+        """Check no socket is returned without socket activation"""
+        self.assertEqual(landiallerd.get_activated_socket(self.fd), None)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+        """Check metrics are rendered in the Prometheus text format"""
+        metrics = landiallerd.Metrics()
+        metrics.describe('calls_total', 'counter', 'Calls.')
+        metrics.describe('call_seconds', 'histogram', 'Call time.')
+        metrics.describe('clients', 'gauge', 'Clients.')
+        metrics.inc('calls_total', (('method', 'connect'),))
+        metrics.inc('calls_total', (('method', 'connect'),))
+        metrics.observe('call_seconds', 0.002)
+        metrics.observe('call_seconds', 2)
+        metrics.set_gauge('clients', lambda: 3)
+        lines = metrics.render().splitlines()
+        self.assert_('# TYPE calls_total counter' in lines)
+        self.assert_('calls_total{method="connect"} 2' in lines)
+        self.assert_('call_seconds_bucket{le="0.001"} 0' in lines)
+        self.assert_('call_seconds_bucket{le="0.005"} 1' in lines)
+        self.assert_('call_seconds_bucket{le="+Inf"} 2' in lines)
+        self.assert_('call_seconds_count 2' in lines)
+        self.assert_('clients 3' in lines)
+
+    def test_api_instrumented(self):
+        """Check API calls and dial attempts are counted"""
+        metrics = landiallerd.metrics
+        calls = (('method', 'get_status'),)
+        before = metrics.get('landialler_api_call_seconds', calls)
+        dials = metrics.get('landialler_dial_attempts_total')
+        modem = mock.Mock({'is_connected': False})
+        modem.timer = MockTimer()
+        api = landiallerd.API(landiallerd.ModemProxy(modem))
+        api.connect('client-id-1')
+        api.get_status('client-id-1')
+        self.assertEqual(metrics.get('landialler_api_call_seconds', calls),
+                         before + 1)
+        calls = (('method', 'get_status_many'),)
+        before = metrics.get('landialler_api_call_seconds', calls)
+        api.get_status_many(['client-id-1', 'client-id-2'])
+        self.assertEqual(metrics.get('landialler_api_call_seconds', calls),
+                         before + 1)
+        self.assertEqual(metrics.get('landialler_dial_attempts_total'),
+                         dials + 1)
+
+    def test_metrics_server(self):
+        """Check the metrics are served over HTTP"""
+        server = landiallerd.MetricsServer(('localhost', 0))
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            conn = httplib.HTTPConnection('localhost', server.server_address[1])
+            conn.request('GET', '/metrics')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assert_('landialler_api_calls_total' in response.read())
+        finally:
+            thread.join()
+            server.server_close()
+
+
+class KeepAliveTest(unittest.TestCase):
+
+    def start(self, server, max_keepalive=8, timeout=5):
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        server.register_instance(landiallerd.API(landiallerd.ModemProxy(modem)))
+        server.keepalive_timeout = timeout
+        server.max_keepalive = max_keepalive
+        thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+        thread.setDaemon(True)
+        thread.start()
+        self.server = server
+        self.thread = thread
+        return httplib.HTTPConnection('localhost', server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def post(self, conn):
+        body = xmlrpclib.dumps(('client-id-1',), 'get_status')
+        conn.request('POST', '/RPC2', body, {'Content-Type': 'text/xml'})
+        response = conn.getresponse()
+        response.read()
+        return response
+
+    def check_connection_reused(self, server):
+        conn = self.start(server)
+        self.assertEqual(self.post(conn).status, 200)
+        self.assertEqual(self.post(conn).status, 200)
+        self.assertEqual(server.count_connections(), 1)
+        conn.close()
+
+    def check_connection_limit(self, server):
+        conn = self.start(server, max_keepalive=0)
+        response = self.post(conn)
+        self.assertEqual(response.getheader('connection'), 'close')
+        conn.close()
+
+    def test_threading_connection_reused(self):
+        """Check the threading server keeps connections open"""
+        self.check_connection_reused(landiallerd.ThreadingXMLRPCServer(
+            ('localhost', 0), logRequests=False))
+
+    def test_threading_connection_limit(self):
+        """Check the threading server limits open connections"""
+        self.check_connection_limit(landiallerd.ThreadingXMLRPCServer(
+            ('localhost', 0), logRequests=False))
+
+    def test_async_connection_reused(self):
+        """Check the event loop server keeps connections open"""
+        self.check_connection_reused(
+            landiallerd.AsyncXMLRPCServer(('localhost', 0)))
+
+    def test_async_connection_limit(self):
+        """Check the event loop server limits open connections"""
+        self.check_connection_limit(
+            landiallerd.AsyncXMLRPCServer(('localhost', 0)))
+
+    def test_async_idle_timeout(self):
+        """Check the event loop server closes idle connections"""
+        server = landiallerd.AsyncXMLRPCServer(('localhost', 0))
+        conn = self.start(server, timeout=0.05)
+        self.post(conn)
+        self.assertEqual(server.count_connections(), 1)
+        for i in range(100):
+            if server.count_connections() == 0:
+                break
+            time.sleep(0.02)
+        self.assertEqual(server.count_connections(), 0)
+        conn.close()
+
+
+class FastDispatchTest(unittest.TestCase):
+
+    def make_dispatcher(self, dispatcher_class):
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        proxy = landiallerd.ModemProxy(modem, max_clients=2)
+        dispatcher = dispatcher_class(False, None)
+        dispatcher.register_instance(landiallerd.API(proxy))
+        return dispatcher
+
+    def make_fast_dispatcher(self):
+        class FastDispatcher(landiallerd.FastDispatchMixin,
+                             landiallerd.SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
+            pass
+        return self.make_dispatcher(FastDispatcher)
+
+    def make_slow_dispatcher(self):
+        return self.make_dispatcher(
+            landiallerd.SimpleXMLRPCServer.SimpleXMLRPCDispatcher)
+
+    def check_same_response(self, *calls):
+        fast = self.make_fast_dispatcher()
+        slow = self.make_slow_dispatcher()
+        for params, method in calls:
+            request = xmlrpclib.dumps(params, method)
+            self.assertEqual(fast._marshaled_dispatch(request),
+                             slow._marshaled_dispatch(request))
+
+    def test_core_methods(self):
+        """Check the fast path matches the generic marshaller"""
+        self.check_same_response((('client-id-1',), 'connect'),
+                                 (('client-id-1',), 'get_status'),
+                                 (('client-id-1', True), 'disconnect'),
+                                 (('client-id-1',), 'disconnect'))
+
+    def test_rate_limited(self):
+        """Check rejected calls get the same fault from the fast path"""
+        fast = self.make_fast_dispatcher()
+        slow = self.make_slow_dispatcher()
+        for dispatcher in (fast, slow):
+            api = dispatcher.instance
+            api.client_limiter = landiallerd.RateLimiter(0, 1)
+            api.get_status('client-id-1')
+        request = xmlrpclib.dumps(('client-id-1',), 'get_status')
+        self.assertEqual(fast._marshaled_dispatch(request),
+                         slow._marshaled_dispatch(request))
+
+    def test_escaped_client_id(self):
+        """Check client ids with escaped characters are handled"""
+        self.check_same_response((('<client & co>',), 'connect'),
+                                 (('<client & co>',), 'get_status'))
+
+    def test_non_ascii_client_id(self):
+        """Check non-ASCII client ids are decoded like any other call"""
+        fast = self.make_fast_dispatcher()
+        for method in ('connect', 'get_status', 'get_status_many'):
+            client_id = u'J\xf6rg'
+            if method == 'get_status_many':
+                client_id = [client_id]
+            fast._marshaled_dispatch(xmlrpclib.dumps((client_id,), method))
+        proxy = fast.instance._modem_proxy
+        self.assertEqual(proxy.client_ids(), [u'J\xf6rg'])
+
+    def test_other_methods(self):
+        """Check other methods still work"""
+        self.check_same_response(((['client-id-1'],), 'get_status_many'))
+
+    def test_untyped_string(self):
+        """Check client ids sent without a type are understood"""
+        fast = self.make_fast_dispatcher()
+        request = ('<?xml version="1.0"?><methodCall>'
+                   '<methodName>get_status</methodName><params><param>'
+                   '<value>client-id-1</value></param></params></methodCall>')
+        response = xmlrpclib.loads(fast._marshaled_dispatch(request))
+        self.assertEqual(response, (([1, True, 14],), None))
+
+    def test_fault(self):
+        """Check faults raised by the API are returned"""
+        self.check_same_response((('client-id-1',), 'connect'),
+                                 (('client-id-2',), 'connect'),
+                                 (('client-id-3',), 'connect'))
+
+
+class DatagramServerTest(unittest.TestCase):
+
+    def setUp(self):
+        modem = mock.Mock({'is_connected': True})
+        modem.timer = MockTimer()
+        self.proxy = landiallerd.ModemProxy(modem)
+        api = landiallerd.API(self.proxy)
+        self.server = landiallerd.DatagramServer(('localhost', 0), api)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.sock = landiallerd.socket.socket(landiallerd.socket.AF_INET,
+                                              landiallerd.socket.SOCK_DGRAM)
+        self.sock.settimeout(1)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call(self, opcode, client_id, flags=0):
+        handler = landiallerd.DatagramHandler
+        request = handler.REQUEST.pack('LD', 1, opcode, flags) + client_id
+        self.sock.sendto(request, self.server.server_address)
+        return handler.RESPONSE.unpack(self.sock.recv(64))
+
+    def test_get_status(self):
+        """Check clients can get the status over UDP"""
+        self.call(landiallerd.DatagramHandler.CONNECT, 'client-id-1')
+        self.assertEqual(self.call(3, 'client-id-1'),
+                         ('LD', 1, 3, 0, 1, 1, 14))
+        record = self.proxy.get_client('client-id-1')
+        self.assertEqual(record.address, '127.0.0.1')
+
+    def test_disconnect_all(self):
+        """Check clients can drop the connection for everybody over UDP"""
+        handler = landiallerd.DatagramHandler
+        self.call(handler.CONNECT, 'client-id-1')
+        self.call(handler.CONNECT, 'client-id-2')
+        self.call(handler.DISCONNECT, 'client-id-1', handler.DISCONNECT_ALL)
+        self.assertEqual(self.proxy.state, self.proxy.HANGING_UP)
+
+    def test_bad_request(self):
+        """Check unknown opcodes are rejected"""
+        self.assertEqual(self.call(9, 'client-id-1')[3],
+                         landiallerd.DatagramHandler.BAD_REQUEST)
+
+    def test_rate_limited(self):
+        """Check clients making too many requests are told so"""
+        handler = landiallerd.DatagramHandler
+        self.server.api.address_limiter = landiallerd.RateLimiter(0, 1)
+        self.assertEqual(self.call(handler.CONNECT, 'client-id-1')[3],
+                         handler.OK)
+        self.assertEqual(self.call(handler.CONNECT, 'client-id-1')[3],
+                         handler.BUSY)
+
+
 if __name__ == '__main__':
     unittest.main()